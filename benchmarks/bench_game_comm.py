@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+#
+# Measures GameComm decoding speed on a recorded stream of
+# server->client update messages.
+#
+import sys, os, time, getopt, socket, errno, re, threading, tempfile
+sys.path.append('..')
+from common.game_comm import *
+from common.player import PlayerData
+from common.npc import NPCData
+from common.wall import WallData
+from common.missile import MissileData
+from common.object_message import message_to_object, object_to_message, ObjectDeltaTracker
+from common.transport import loopback_pair, SocketTransport, listen_unix, accept_transport, connect_shm
+from client.client_game_socket import ClientGameSocket
+from engine_client.game_engine import ClientGameEngine
+from engine_server.config import *
+
+class RecordingSocket:
+    """Stands in for a socket, keeping everything that is sent."""
+    def __init__(self):
+        self.chunks = []
+        return
+    def sendall(self, string):
+        self.chunks.append(string)
+        return
+    def send(self, string):
+        self.chunks.append(str(string))
+        return len(string)
+    def get_stream(self):
+        return "".join(self.chunks)
+
+class ReplaySocket:
+    """Stands in for a non-blocking socket, replaying a recorded stream
+       in segments of at most segment_size bytes."""
+    def __init__(self, stream, segment_size):
+        self.stream = stream
+        self.segment_size = segment_size
+        self.pos = 0
+        return
+    def _next(self, n):
+        if self.pos >= len(self.stream):
+            raise socket.error(errno.EAGAIN, "Resource temporarily unavailable")
+        n = min(n, self.segment_size, len(self.stream) - self.pos)
+        start = self.pos
+        self.pos += n
+        return start, n
+    def recv(self, n):
+        start, n = self._next(n)
+        return self.stream[start:start+n]
+    def recv_into(self, buf, n=0):
+        start, n = self._next(n or len(buf))
+        buf[0:n] = self.stream[start:start+n]
+        return n
+    def sendall(self, string):
+        return
+    def send(self, string):
+        return len(string)
+
+class StringBufferReader:
+    """The previous reader: recv() into a str buffer, bodies sliced as copies."""
+    FRAME_HEADER = re.compile(r'\s*(\S+)\s\s*(\d+)\D')
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = ""
+        self.pos = 0
+        return
+    def read_mesgs(self):
+        msgs = []
+        while True:
+            match = self.FRAME_HEADER.match(self.buffer, self.pos)
+            if match and match.end() + int(match.group(2)) <= len(self.buffer):
+                end = match.end() + int(match.group(2))
+                msgs.append(ALL_MESSAGES[match.group(1)](self.buffer[match.end():end]))
+                self.pos = end
+                continue
+            if msgs:
+                return msgs
+            try:
+                data = self.sock.recv(RECV_SIZE)
+            except socket.error:
+                return [GameMessageEagain()]
+            self.buffer = self.buffer[self.pos:] + data
+            self.pos = 0
+
+def make_comm(capabilities):
+    """returns a function that builds a GameComm already using capabilities"""
+    def make(sock):
+        comm = GameComm(sock)
+        comm.enable_capabilities(capabilities)
+        return comm
+    return make
+
+def write_update(comm, tracker, obj, tick_time):
+    """writes obj's full update, or what the tracker decides this client needs"""
+    if tracker is None:
+        comm.write_mesg(object_to_message(obj))
+        return
+    msg = tracker.update_message(obj, tick_time)
+    if msg is not None:
+        comm.write_mesg(msg)
+    return
+
+def record_stream(ticks, capabilities=[]):
+    """Builds the stream a client receives: the walls once,
+       then two players, the NPCs and a few missiles every tick.
+       With DELTA_UPDATES, MISSILE_SPAWNS or EXTRAPOLATION, the
+       objects go through an ObjectDeltaTracker."""
+    sock = RecordingSocket()
+    comm = make_comm(capabilities)(sock)
+    tracker = None
+    if C_DELTA_UPDATES in capabilities or uses_missile_spawns(capabilities) or uses_extrapolation(capabilities):
+        tracker = ObjectDeltaTracker(uses_missile_spawns(capabilities), uses_extrapolation(capabilities))
+    for i in range(NUM_WALLS):
+        wall = WallData(i * WALL_THICK, 0, WALL_THICK, 5 * WALL_THICK)
+        wall.set_oid(i + 1)
+        write_update(comm, tracker, wall, 0.0)
+    for tick in range(ticks):
+        tick_time = tick / 30.0
+        if C_TICKS in capabilities:
+            comm.write_mesg(TickMessage(tick, tick_time))
+        for i in range(2):
+            player = PlayerData(100.0 + tick / 3.0, 200.0 + i * 17.3, PLAYER_WIDTH, PLAYER_HEIGHT)
+            player.set_oid(100 + i)
+            player.set_move_mana_max(MOVE_MANA_MAX[2][0])
+            player.set_move_mana_recharge_rate(MOVE_MANA_RECHARGE_RATE[1][0])
+            player.set_move_mana(7.123456789 + tick_time)
+            player.set_missile_mana_max(MISSILE_MANA_MAX[2][0])
+            player.set_missile_mana_recharge_rate(MISSILE_MANA_RECHARGE_RATE[1][0])
+            player.set_missile_mana(3.987654321 + tick_time)
+            write_update(comm, tracker, player, tick_time)
+        for i in range(NUM_NPCS):
+            npc = NPCData(50.0 * i + tick / 7.0, 300.0 - tick / 11.0, NPC_WIDTH, NPC_HEIGHT)
+            npc.set_oid(200 + i)
+            write_update(comm, tracker, npc, tick_time)
+        for i in range(5):
+            missile = MissileData(120.0 + tick * 2.6667, 210.0 + i, MISSILE_WIDTH, MISSILE_HEIGHT, 100)
+            missile.set_oid(300 + i)
+            missile.set_distance(tick * 2.6667)
+            missile.set_speed(MISSILE_SPEED)
+            missile.set_range(MISSILE_RANGE_LONG[0])
+            write_update(comm, tracker, missile, tick_time)
+    return sock.get_stream()
+
+def run_reader(make_reader, stream, segment_size, repeat):
+    best = None
+    count = 0
+    for r in range(repeat):
+        reader = make_reader(ReplaySocket(stream, segment_size))
+        count = 0
+        start = time.time()
+        while True:
+            msgs = reader.read_mesgs()
+            if msgs[-1].get_command() == M_EAGAIN:
+                break
+            count += len(msgs)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return count, best
+
+def run_object_reader(make_reader, direct, stream, segment_size, repeat):
+    """Like run_reader(), but also stores every object update,
+       as the client engine does.  With direct, the updates are
+       decoded straight into the stored objects."""
+    best = None
+    count = 0
+    for r in range(repeat):
+        reader = make_reader(ReplaySocket(stream, segment_size))
+        objects = {}
+        if direct:
+            reader.set_object_lookup(objects.get)
+        count = 0
+        start = time.time()
+        while True:
+            msgs = reader.read_mesgs()
+            if msgs[-1].get_command() == M_EAGAIN:
+                break
+            for msg in msgs:
+                obj = message_to_object(msg)
+                objects[obj.get_oid()] = obj
+            count += len(msgs)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return count, best
+
+def socket_pair():
+    a, b = socket.socketpair()
+    return SocketTransport(a), SocketTransport(b)
+
+def shm_pair():
+    path = os.path.join(tempfile.gettempdir(), "bench_game_comm.sock")
+    listener = listen_unix(path)
+    accepted = []
+    thread = threading.Thread(target=lambda: accepted.append(accept_transport(listener)))
+    thread.start()
+    client_end = connect_shm(path)
+    thread.join()
+    listener.close()
+    os.unlink(path)
+    return client_end, accepted[0]
+
+def run_engine(make_pair, ticks, capabilities, repeat):
+    """Drives a ClientGameEngine through ClientGameSocket, the server side
+       writing one tick of updates at a time to the other end of the pair.
+       Returns (messages, best time, stream bytes)."""
+    stream = record_stream(ticks, capabilities)
+    best = None
+    count = 0
+    for r in range(repeat):
+        client_end, server_end = make_pair()
+        server_end.setblocking(0)
+        game_socket = ClientGameSocket([], capabilities=capabilities, transport=client_end)
+        game_socket.connect_to_server()
+        game_socket.game_comm.enable_capabilities(capabilities)
+        engine = ClientGameEngine("bench")
+        count = 0
+        start = time.time()
+        pos = 0
+        while True:
+            if pos < len(stream):
+                try:
+                    pos += server_end.send(buffer(stream, pos, 16384))
+                except socket.error:
+                    pass
+            msgs = game_socket.game_comm.read_mesgs()
+            for msg in msgs:
+                if msg.get_command() != M_EAGAIN:
+                    engine.process_server_message(msg)
+                    count += 1
+            if pos >= len(stream) and msgs[-1].get_command() == M_EAGAIN:
+                break
+        elapsed = time.time() - start
+        game_socket.disconnect_from_server()
+        if best is None or elapsed < best:
+            best = elapsed
+    return count, best, len(stream)
+
+def report(name, count, elapsed, nbytes):
+    print "%-24s %7d msgs %8.3f s %10.0f msgs/s %7.1f MB/s" % (name, count, elapsed, count / elapsed,
+                                                               nbytes / elapsed / 1e6)
+    return
+
+def usage():
+    print "usage: %s [-t|--ticks n] [-s|--segment bytes] [-r|--repeat n] [-w|--write file] [-f|--file file] [-h|--help]" % (sys.argv[0])
+    print "-t|--ticks n       : number of server ticks to record"
+    print "-s|--segment bytes : largest chunk delivered by one recv"
+    print "-r|--repeat n      : runs per reader, the fastest is reported"
+    print "-w|--write file    : save the recorded stream to file"
+    print "-f|--file file     : replay a stream saved earlier, instead of recording"
+    print "-h|--help          : show this message and exit"
+    return
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "ht:s:r:w:f:", ["help", "ticks=", "segment=", "repeat=", "write=", "file="])
+    except getopt.GetoptError as e:
+        print str(e)
+        usage()
+        sys.exit(1)
+
+    ticks = 300
+    segment_size = 1448
+    repeat = 3
+    write_file = None
+    read_file = None
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit(1)
+        elif o in ("-t", "--ticks"):
+            ticks = int(a)
+        elif o in ("-s", "--segment"):
+            segment_size = int(a)
+        elif o in ("-r", "--repeat"):
+            repeat = int(a)
+        elif o in ("-w", "--write"):
+            write_file = a
+        elif o in ("-f", "--file"):
+            read_file = a
+
+    if read_file:
+        stream = open(read_file, "rb").read()
+    else:
+        stream = record_stream(ticks)
+    if write_file:
+        open(write_file, "wb").write(stream)
+    print "stream: %d bytes, %d byte segments" % (len(stream), segment_size)
+
+    count, elapsed = run_reader(StringBufferReader, stream, segment_size, repeat)
+    report("str buffer recv()", count, elapsed, len(stream))
+    count, elapsed = run_reader(make_comm([]), stream, segment_size, repeat)
+    report("GameComm recv_into()", count, elapsed, len(stream))
+
+    if read_file:
+        return
+    for name, make_pair in [ ("engine socketpair", socket_pair),
+                             ("engine loopback", loopback_pair),
+                             ("engine shared memory", shm_pair) ]:
+        count, elapsed, nbytes = run_engine(make_pair, ticks, [C_BINARY_OBJECTS], repeat)
+        report(name, count, elapsed, nbytes)
+    for name, capabilities in [ ("objects via dict", []),
+                                ("binary objects via dict", [C_BINARY_OBJECTS]) ]:
+        object_stream = record_stream(ticks, capabilities)
+        count, elapsed = run_object_reader(make_comm(capabilities), False, object_stream, segment_size, repeat)
+        report(name, count, elapsed, len(object_stream))
+        count, elapsed = run_object_reader(make_comm(capabilities), True, object_stream, segment_size, repeat)
+        report(name.replace("via dict", "direct"), count, elapsed, len(object_stream))
+    for name, capabilities in [ ("GameComm binary", [C_BINARY_OBJECTS]),
+                                ("GameComm quantized", [C_BINARY_OBJECTS, C_QUANTIZED_COORDS]),
+                                ("GameComm binary compact", [C_BINARY_OBJECTS, C_COMPACT_HEADERS]),
+                                ("GameComm binary ticks", [C_BINARY_OBJECTS, C_TICKS]),
+                                ("GameComm binary messages", [C_BINARY_OBJECTS, C_TICKS, C_BINARY_MESSAGES]),
+                                ("GameComm binary deltas", [C_BINARY_OBJECTS, C_TICKS, C_DELTA_UPDATES]),
+                                ("GameComm missile spawns", [C_BINARY_OBJECTS, C_TICKS, C_DELTA_UPDATES,
+                                                             C_MISSILE_SPAWNS]),
+                                ("GameComm extrapolation", [C_BINARY_OBJECTS, C_TICKS, C_DELTA_UPDATES,
+                                                            C_MISSILE_SPAWNS, C_EXTRAPOLATION]),
+                                ("GameComm zlib", [C_COMPRESSION]),
+                                ("GameComm binary zlib", [C_BINARY_OBJECTS, C_COMPRESSION]) ]:
+        binary_stream = record_stream(ticks, capabilities)
+        count, elapsed = run_reader(make_comm(capabilities), binary_stream, segment_size, repeat)
+        report(name, count, elapsed, len(binary_stream))
+        print "%-24s %7d bytes, %.1fx smaller" % ("", len(binary_stream), float(len(stream)) / len(binary_stream))
+    return
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,7 @@
 #
 import socket, select, logging
 from common.game_comm import *
+from common.transport import connect_transport
 
 class ClientGameSocket:
     """
@@ -10,21 +11,38 @@ class ClientGameSocket:
     from the client to the server.
 
     Methods:
-    get_sock()                  : returns socket object 
+    get_sock()                  : returns the transport, see common.transport
     connect_to_server()         : connects to the configured server
     disconnect_from_server()    : disconnects from the server
     is_ready(fd)                : true if fd belongs to socket object
+    is_readable()               : true if a transport that can't be select()ed has data
+    has_capability(capability)  : true if connected, with capability agreed at LOGIN
+    check_connection()          : sends a HEARTBEAT when due, false if the server went silent
+    needs_reconnect()           : true once the server closed or went silent, until reconnected
+    open_channel(engine, mode)  : starts another match on this connection, for engine
+    close_channel(channel)      : stops routing a channel's messages to its engine
+    get_channel_engine(channel) : returns the engine of an open channel, or None
     send_messages(engine)       : sends all messages to game server, empties engine queue
-    process_event(engine)       : receives one message from server, updates engine
+                                  and those of the open channels, retries output the
+                                  socket could not take earlier
+    send_priority_messages(engine) : sends the engine's priority queue right away
+    process_event(engine)       : receives all available messages from server, updates engine,
+                                  or the engine of the channel a message belongs to
     """
 
-    def __init__(self, read_list, server_host="127.0.0.1", server_port=9999):
+    def __init__(self, read_list, server_host="127.0.0.1", server_port=9999, capabilities=None, transport=None):
         self.logger = logging.getLogger('ClientGameSocket')
         self.logger.debug('__init__')
         self.read_list = read_list
         self.server_host = server_host
         self.server_port = server_port
+        self.capabilities = capabilities # offered at LOGIN, None for the defaults for server_host
+        self.transport = transport # already connected transport to use, such as a loopback_pair() end
         self.sock = None
+        self.game_comm = None
+        self.channels = {}   # engine of each open channel, by channel id, see open_channel()
+        self.next_channel = 1 # channel 0 is the match of the login, the engine passed in
+        self.reconnect = False # True once the connection was lost, see needs_reconnect()
         return
 
     def get_sock(self):
@@ -32,14 +50,23 @@ class ClientGameSocket:
 
     def connect_to_server(self):
         try:
-            # build the socket to remote
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            # connect to server
-            self.sock.connect( (self.server_host, self.server_port) )
+            if self.transport is not None:
+                self.sock = self.transport
+            else:
+                # TCP, or a Unix domain socket for a "unix:path" host
+                self.sock = connect_transport(self.server_host, self.server_port)
             # register for select
-            self.read_list.append(self.sock.fileno())
+            if self.sock.fileno() is not None:
+                self.read_list.append(self.sock.fileno())
             # make non-blocking so recv errors will trigger an exception
             self.sock.setblocking(0)
+            # one GameComm for the life of the connection, so a partially
+            # received frame is resumed by the next event instead of lost
+            capabilities = self.capabilities
+            if capabilities is None:
+                capabilities = default_capabilities(self.server_host)
+            self.game_comm = GameComm(self.sock, capabilities)
+            self.reconnect = False
         except socket.error as e:
             self.logger.error("socket.error: %s", e)
             raise
@@ -49,42 +76,160 @@ class ClientGameSocket:
         try:
             if self.sock:
                 # unregister from select
-                if self.sock.fileno() in self.read_list:
+                if self.sock.fileno() is not None and self.sock.fileno() in self.read_list:
                     self.read_list.remove(self.sock.fileno())
                 # close socket
                 self.sock.close()
                 # remove reference
                 self.sock = None
+                self.game_comm = None
+                self.channels = {}
+                self.next_channel = 1
         except socket.error as e:
             self.logger.error("socket.error: %s", e)
             raise
         return
 
+    def has_capability(self, capability):
+        """True if connected, with capability agreed at LOGIN"""
+        return self.game_comm is not None and self.game_comm.has_capability(capability)
+
+    def check_connection(self, now=None):
+        """
+        Call regularly.  Writes a HEARTBEAT if nothing else was sent
+        lately.  If the server, having agreed to HEARTBEATS, has sent
+        nothing for the idle timeout, or the HEARTBEAT can't be written,
+        the connection is closed, and needs_reconnect() is True.
+        Returns False in that case.
+        """
+        if self.game_comm is None:
+            return True
+        if not self.game_comm.is_timed_out(now):
+            self.game_comm.heartbeat(now)
+            if self.game_comm:
+                return True
+        self.logger.warning("Server silent for %.1f s, disconnecting.", self.game_comm.get_idle_time(now))
+        self.disconnect_from_server()
+        self.reconnect = True
+        return False
+
+    def needs_reconnect(self):
+        return self.reconnect
+
+    def open_channel(self, engine, mode):
+        """
+        Starts another match on this connection, played or watched by
+        engine in mode, after the login of channel 0 succeeded.
+        Its messages are routed to engine, and its queue is sent along
+        with the others by send_messages().
+        Returns the channel id, or None if the server does not accept CHANNELS.
+        """
+        if not self.has_capability(C_CHANNELS):
+            self.logger.error("open_channel: server does not accept %s", C_CHANNELS)
+            return None
+        channel = self.next_channel
+        self.next_channel += 1
+        self.channels[channel] = engine
+        self.game_comm.set_object_lookup(engine.get_object, channel)
+        engine.set_missile_spawns(uses_missile_spawns(self.game_comm.get_capabilities()))
+        engine.set_extrapolation(uses_extrapolation(self.game_comm.get_capabilities()))
+        # the connection is logged in, only the mode request is needed
+        engine.next_game(mode)
+        return channel
+
+    def close_channel(self, channel):
+        """Tells the server to close channel, and drops what it still
+           has queued.  Its messages still in flight are ignored."""
+        if channel in self.channels:
+            del self.channels[channel]
+            msg = CloseChannelMessage()
+            msg.set_channel(channel)
+            if not self.game_comm.write_mesg(msg):
+                self.logger.error("Error closing channel %d", channel)
+            self.game_comm.close_channel(channel)
+        return
+
+    def get_channel_engine(self, channel):
+        if not channel in self.channels:
+            return None
+        return self.channels[channel]
+
+    def _take_channel_messages(self):
+        """returns the queued messages of every open channel, tagged with
+           their channel, and empties the queues"""
+        msgs = []
+        for channel in sorted(self.channels.keys()):
+            engine = self.channels[channel]
+            queued = engine.get_priority_queue() + engine.get_message_queue()
+            for msg in queued:
+                msg.set_channel(channel)
+            msgs.extend(queued)
+            engine.clear_priority_queue()
+            engine.clear_message_queue()
+        return msgs
+
     def is_ready(self, fd):
         return self.sock and fd == self.sock.fileno()
 
+    def is_readable(self):
+        return bool(self.sock) and self.sock.fileno() is None and self.sock.readable()
+
     def send_messages(self, engine):
-        if not engine: return
+        if not engine or not self.game_comm: return
         try:
-            gc = GameComm(self.sock)
-            for msg in engine.get_message_queue():
-                if not gc.write_mesg(msg):
-                    self.logger.error("Error writing message: %s", msg)
+            msgs = engine.get_priority_queue() + engine.get_message_queue()
+            engine.clear_priority_queue()
             engine.clear_message_queue()
+            if self.channels:
+                # every match's messages in one write
+                msgs += self._take_channel_messages()
+            if msgs:
+                if not self.game_comm.write_mesgs(msgs):
+                    self.logger.error("Error writing messages: %s", msgs)
+            elif self.game_comm.has_pending_output():
+                # the tail of an earlier write the socket could not take
+                self.game_comm.flush()
         except:
             self.logger.error("Error in send_messages.")
             raise
         return
         
+    def send_priority_messages(self, engine):
+        """Sends the latency-critical messages now, leaving the rest for send_messages()."""
+        if not engine or not self.game_comm: return
+        msgs = engine.get_priority_queue()
+        if msgs:
+            if not self.game_comm.write_mesgs(msgs):
+                self.logger.error("Error writing messages: %s", msgs)
+            engine.clear_priority_queue()
+        return
+        
     def process_event(self, engine):
         """Should not be called unless there is a message to read from the socket."""
         
+        if engine and self.game_comm.get_object_lookup() is None:
+            # object updates are decoded straight into the engine's objects
+            self.game_comm.set_object_lookup(engine.get_object)
         try:
-            gc = GameComm(self.sock)
-            msg = gc.read_mesg()
+            msgs = self.game_comm.read_mesgs()
         except:
             raise
-            
+
+        for msg in msgs:
+            channel = msg.get_channel()
+            if channel:
+                if not channel in self.channels:
+                    self.logger.info("Dropping message for closed channel %d.", channel)
+                    continue
+                self.process_message(self.channels[channel], msg)
+            else:
+                self.process_message(engine, msg)
+            if not self.sock:
+                break
+        return
+
+    def process_message(self, engine, msg):
+        """Handles one message received from the server."""
         code = msg.get_command()
         if code == M_ECHO:
             print msg.get_text()
@@ -94,10 +239,15 @@ class ClientGameSocket:
             print
             self.logger.info("Closing connection from server.")
             self.disconnect_from_server()
+            self.reconnect = True
+        elif (code == M_BAD_COMMAND or code == M_NONE) and not self.game_comm:
+            # the GameComm has failed, and no longer reads the socket
+            self.logger.error("Closing failed connection to server.")
+            self.disconnect_from_server()
+            self.reconnect = True
         elif code == M_EAGAIN:
             self.logger.info("Waiting to try again.")
         else:
             if engine:
                 engine.process_server_message(msg)
         return
-
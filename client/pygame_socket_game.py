@@ -4,6 +4,7 @@
 import socket, select, sys, logging
 from client.pygame_game import PygameGame
 from client.client_game_socket import ClientGameSocket
+from common.game_comm import C_SESSIONS
 
 class PygameSocketGame(PygameGame):
     """
@@ -20,6 +21,9 @@ class PygameSocketGame(PygameGame):
     set_engine(engine)
     connect_to_server()
     disconnect_from_server()
+    leave_game()
+    resume_session(mode)
+    connection_lost()
     generate_external_events()
     """
 
@@ -30,7 +34,8 @@ class PygameSocketGame(PygameGame):
         self.server_host = server_host
         self.server_port = server_port
         self.client_game_socket = ClientGameSocket(self.read_list, self.server_host, self.server_port)
-        self.engine = engine
+        self.lobby_engine = None # engine of the last game, while its connection waits in the lobby
+        self.set_engine(engine)
         return
 
     def get_sock(self):
@@ -38,6 +43,13 @@ class PygameSocketGame(PygameGame):
         
     def set_engine(self, engine):
         self.engine = engine
+        if engine:
+            # missiles are fired without waiting for the next frame
+            engine.set_priority_callback(self.send_priority_messages)
+        return
+
+    def send_priority_messages(self):
+        self.client_game_socket.send_priority_messages(self.engine)
         return
         
     def connect_to_server(self):
@@ -48,7 +60,49 @@ class PygameSocketGame(PygameGame):
         self.client_game_socket.disconnect_from_server()
         return
         
+    def leave_game(self):
+        """
+        Drops the engine after a game.  If the server keeps sessions,
+        the connection stays open and logged in, for resume_session().
+        """
+        if self.engine and self.client_game_socket.has_capability(C_SESSIONS):
+            self.lobby_engine = self.engine
+        else:
+            self.lobby_engine = None
+            self.disconnect_from_server()
+        self.set_engine(None)
+        return
+
+    def resume_session(self, mode):
+        """
+        Starts the next game on the connection kept by leave_game().
+        Returns False if there is none, and a new connection is needed.
+        """
+        engine = self.lobby_engine
+        self.lobby_engine = None
+        if engine is None or not self.client_game_socket.get_sock():
+            return False
+        engine.next_game(mode)
+        self.set_engine(engine)
+        return True
+
+    def connection_lost(self):
+        """
+        The server closed the connection, or stopped answering.
+        The games on it are dropped, except one already over, still
+        on display.  The next new game connects again.
+        """
+        self.lobby_engine = None
+        if self.engine and not self.engine.get_data().get_game_over():
+            self.logger.warning("connection_lost: dropping the game")
+            self.set_engine(None)
+        return
+
     def socket_is_ready(self):
+        if self.client_game_socket.is_readable():
+            return True
+        if not self.read_list:
+            return False
         rds, wrs, xs = select.select(self.read_list, [], [], 0.0)
         for fd in rds:
             if self.client_game_socket.is_ready(fd):
@@ -56,10 +110,15 @@ class PygameSocketGame(PygameGame):
         return False
         
     def generate_external_events(self):
-        if self.engine:
+        # in the lobby, the kept engine watches the connection
+        engine = self.engine or self.lobby_engine
+        if engine:
             # receive incoming messages
             while self.socket_is_ready():
-                self.client_game_socket.process_event(self.engine)
+                self.client_game_socket.process_event(engine)
             # send outgoing messages
-            self.client_game_socket.send_messages(self.engine)
+            self.client_game_socket.send_messages(engine)
+            self.client_game_socket.check_connection()
+            if self.client_game_socket.needs_reconnect():
+                self.connection_lost()
         return
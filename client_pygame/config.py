@@ -1,4 +1,4 @@
-import sys
+import sys, os
 sys.path.append('..')
 from engine_server.config import *
 
@@ -17,6 +17,16 @@ DEFAULT_TEAM_NAME  = "Piano++"
 # computer, you can try to make this larger.
 FRAMES_PER_SECOND = 30
 
+# Movement and missile settings are only sent to the server when
+# they change.  This resends an unchanged setting after this many
+# seconds, in case the server missed it.  None never resends.
+COMMAND_KEEP_ALIVE = 1.0 # seconds
+
+# The walls of maps already played are kept in this directory,
+# so that they are not downloaded again.  None keeps them in
+# memory only, until the client exits.
+MAP_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".codecamp2014", "maps")
+
 # This is how long to wait after the game is over
 # before returning to the pre-game display
 POST_GAME_WAIT_TIME = 5 # seconds
@@ -163,8 +163,8 @@ class Control(BaseControl):
 
                 
         if pygame.K_SPACE in newkeys:
-            engine.fire_missile()
-
+            # range and power first: fire_missile() sends right away,
+            # with the settings queued before it
             oid = engine.get_player_oid()
             player = engine.get_object(oid)
             if player.get_experience() >= 30:
@@ -181,6 +181,8 @@ class Control(BaseControl):
             else:
                 engine.set_missile_power_low()
 
+            engine.fire_missile()
+
 
         #if pygame.K_i in newkeys:
             #self.show_info = not self.show_info
@@ -8,6 +8,7 @@ from client.base_control import *
 from client.pygame_socket_game import PygameSocketGame
 from common.game_comm import *
 from engine_client.game_engine import ClientGameEngine
+from engine_client.map_cache import MapCache
 import engine_client.game_engine as game_engine
 from display.display import Display
 from control.control import Control
@@ -23,6 +24,7 @@ class PygameClient(PygameSocketGame):
         self.name = name
         self.display = Display(width, height)
         self.control = Control(width, height)
+        self.map_cache = MapCache(MAP_CACHE_DIR)
         return
     
     def game_logic(self, keys, newkeys, buttons, newbuttons, mouse_position):
@@ -40,8 +42,7 @@ class PygameClient(PygameSocketGame):
         if self.engine and self.engine.get_data().get_game_over():
             self.game_over_pause += 1
             if self.game_over_pause > self.frames_per_second * POST_GAME_WAIT_TIME:
-                self.disconnect_from_server()
-                self.set_engine(None)
+                self.leave_game()
         return
 
     def paint(self, surface):
@@ -49,8 +50,9 @@ class PygameClient(PygameSocketGame):
         return
     
     def new_game(self, mode):
-        self.set_engine(ClientGameEngine(self.name, mode))
-        self.disconnect_from_server()
-        self.connect_to_server()
+        if not self.resume_session(mode):
+            self.set_engine(ClientGameEngine(self.name, mode, COMMAND_KEEP_ALIVE, self.map_cache))
+            self.disconnect_from_server()
+            self.connect_to_server()
         self.game_over_pause = 0
         return
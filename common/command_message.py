@@ -1,7 +1,8 @@
 #
 # Don't change this file
 #
-from common.game_message import GameMessage
+from common.game_message import GameMessage, register_client_handler
+from common.message_schema import schema_message, message_decoders
 
 #
 # client->server commands
@@ -30,106 +31,38 @@ T_POWER_LOW     = "POWER_LOW"
 T_POWER_MEDIUM  = "POWER_MEDIUM"
 T_POWER_HIGH    = "POWER_HIGH"
 
+# the values of each enumerated field, in the order of their binary index
+SPEEDS = (T_SPEED_STOP, T_SPEED_SLOW, T_SPEED_MEDIUM, T_SPEED_FAST)
+RANGES = (T_RANGE_NONE, T_RANGE_SHORT, T_RANGE_MEDIUM, T_RANGE_LONG)
+POWERS = (T_POWER_NONE, T_POWER_LOW, T_POWER_MEDIUM, T_POWER_HIGH)
+
+@schema_message(M_REQUEST_PLAYER_OID)
 class RequestPlayerOidMessage(GameMessage):
-    def __init__(self):
-        GameMessage.__init__(self, M_REQUEST_PLAYER_OID)
-        return
-        
-def string_to_request_player_oid_message(string):
-    msg = RequestPlayerOidMessage()
-    msg.from_string(string)
-    return msg
+    pass
 
+@schema_message(M_SET_PLAYER_SPEED, [ ('speed', SPEEDS, T_SPEED_STOP) ])
 class SetPlayerSpeedMessage(GameMessage):
-    def __init__(self, speed=T_SPEED_STOP):
-        GameMessage.__init__(self, M_SET_PLAYER_SPEED)
-        self.set_speed(speed)
-        return
-    def set_speed(self, speed=T_SPEED_STOP):
-        self.set_data("speed", speed)
-        return
-    def get_speed(self):
-        return self.get_data("speed")
-        
-def string_to_set_player_speed_message(string):
-    msg = SetPlayerSpeedMessage()
-    msg.from_string(string)
-    return msg
+    pass
 
-        
+@schema_message(M_SET_PLAYER_DIRECTION, [ ('degrees', 'float', 0.) ])
 class SetPlayerDirectionMessage(GameMessage):
-    def __init__(self, degrees=0.):
-        GameMessage.__init__(self, M_SET_PLAYER_DIRECTION)
-        self.set_degrees(degrees)
-        return
-    def set_degrees(self, degrees=0.):
-        self.set_data("degrees", degrees)
-        return
-    def get_degrees(self):
-        return self.get_data("degrees")
-
-def string_to_set_player_direction_message(string):
-    msg = SetPlayerDirectionMessage()
-    msg.from_string(string)
-    return msg
+    pass
 
+@schema_message(M_SET_MISSILE_RANGE, [ ('range', RANGES, T_RANGE_SHORT) ])
 class SetMissileRangeMessage(GameMessage):
-    def __init__(self, mrange=T_RANGE_SHORT):
-        GameMessage.__init__(self, M_SET_MISSILE_RANGE)
-        self.set_range(mrange)
-        return
-    def set_range(self, mrange=T_RANGE_SHORT):
-        self.set_data("range", mrange)
-        return
-    def get_range(self):
-        return self.get_data("range")
-        
-def string_to_set_missile_range_message(string):
-    msg = SetMissileRangeMessage()
-    msg.from_string(string)
-    return msg
+    pass
 
+@schema_message(M_SET_MISSILE_DIRECTION, [ ('degrees', 'float', 0.) ])
 class SetMissileDirectionMessage(GameMessage):
-    def __init__(self, degrees=0.):
-        GameMessage.__init__(self, M_SET_MISSILE_DIRECTION)
-        self.set_degrees(degrees)
-        return
-    def set_degrees(self, degrees=0.):
-        self.set_data("degrees", degrees)
-        return
-    def get_degrees(self):
-        return self.get_data("degrees")
-
-def string_to_set_missile_direction_message(string):
-    msg = SetMissileDirectionMessage()
-    msg.from_string(string)
-    return msg
+    pass
 
+@schema_message(M_SET_MISSILE_POWER, [ ('power', POWERS, T_POWER_LOW) ])
 class SetMissilePowerMessage(GameMessage):
-    def __init__(self, power=T_POWER_LOW):
-        GameMessage.__init__(self, M_SET_MISSILE_POWER)
-        self.set_power(power)
-        return
-    def set_power(self, power=T_POWER_LOW):
-        self.set_data("power", power)
-        return
-    def get_power(self):
-        return self.get_data("power")
-        
-def string_to_set_missile_power_message(string):
-    msg = SetMissilePowerMessage()
-    msg.from_string(string)
-    return msg
+    pass
 
+@schema_message(M_FIRE_MISSILE)
 class FireMissileMessage(GameMessage):
-    def __init__(self):
-        GameMessage.__init__(self, M_FIRE_MISSILE)
-        return
-
-def string_to_fire_missile_message(string):
-    msg = FireMissileMessage()
-    msg.from_string(string)
-    return msg
+    pass
         
         
 #
@@ -137,30 +70,17 @@ def string_to_fire_missile_message(string):
 #
 M_PLAYER_OID = "PLAYER_OID"
 
+@schema_message(M_PLAYER_OID, [ ('oid', 'int', -1) ])
 class PlayerOidMessage(GameMessage):
-    def __init__(self, oid=-1):
-        GameMessage.__init__(self, M_PLAYER_OID)
-        self.set_oid(oid)
-        return
-    def set_oid(self, oid=-1):
-        self.set_data("oid", oid)
-        return
-    def get_oid(self):
-        return self.get_data("oid")
-        
-def string_to_player_oid_message(string):
-    msg = PlayerOidMessage()
-    msg.from_string(string)
-    return msg
+    pass
 
-        
-# 
-COMMAND_MESSAGES = { M_REQUEST_PLAYER_OID:    string_to_request_player_oid_message,
-                     M_SET_PLAYER_SPEED:      string_to_set_player_speed_message,
-                     M_SET_PLAYER_DIRECTION:  string_to_set_player_direction_message,
-                     M_SET_MISSILE_RANGE:     string_to_set_missile_range_message,
-                     M_SET_MISSILE_DIRECTION: string_to_set_missile_direction_message,
-                     M_SET_MISSILE_POWER:     string_to_set_missile_power_message,
-                     M_FIRE_MISSILE:          string_to_fire_missile_message,
-                     M_PLAYER_OID:            string_to_player_oid_message }
+def handle_player_oid(engine, msg):
+    engine.set_player_oid(msg.get_oid())
+    return
 
+register_client_handler(M_PLAYER_OID, handle_player_oid)
+
+        
+COMMAND_MESSAGES = message_decoders([ RequestPlayerOidMessage, SetPlayerSpeedMessage, SetPlayerDirectionMessage,
+                                      SetMissileRangeMessage, SetMissileDirectionMessage, SetMissilePowerMessage,
+                                      FireMissileMessage, PlayerOidMessage ])
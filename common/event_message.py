@@ -1,7 +1,8 @@
 #
 # Don't change this file
 #
-from common.game_message import GameMessage
+from common.game_message import GameMessage, register_client_handler
+from common.message_schema import schema_message, message_decoders
 from common.event import *
 
 M_EVENT = "M_EVENT"
@@ -10,84 +11,83 @@ M_MISSILE_MISFIRE_EVENT = "M_MISSILE_MISFIRE_EVENT"
 M_MISSILE_HIT_EVENT = "M_MISSILE_HIT_EVENT"
 M_MISSILE_DYING_EVENT = "M_MISSILE_DYING_EVENT"
 
+def set_event(msg, event):
+    """fills in msg for the constructor of an event message"""
+    msg.schema.set_fields(msg)
+    if event:
+        event.set_message(msg)
+    return
+
+@schema_message(M_EVENT, [ ('kind', 'str', E_NONE) ])
 class EventMessage(GameMessage):
     def __init__(self, event=None):
         GameMessage.__init__(self, M_EVENT)
-        if event:
-            event.set_message(self)
+        set_event(self, event)
         return
 
-def string_to_event_message(string):
-    msg = EventMessage()
-    msg.from_string(string)
-    return msg
-    
+# kind is the same in every message of a type: a single valued enumeration
+@schema_message(M_MISSILE_FIRE_EVENT, [ ('kind',          (E_MISSILE_FIRE,), E_MISSILE_FIRE),
+                                        ('player_oid',    'int',   -1),
+                                        ('missile_oid',   'int',   -1),
+                                        ('missile_range', 'float', 0.),
+                                        ('missile_power', 'float', 0.) ])
 class MissileFireEventMessage(GameMessage):
     def __init__(self, event=None):
         GameMessage.__init__(self, M_MISSILE_FIRE_EVENT)
-        if event:
-            event.set_message(self)
+        set_event(self, event)
         return
 
-def string_to_missile_fire_event_message(string):
-    msg = EventMessage()
-    msg.from_string(string)
-    return msg
-    
+@schema_message(M_MISSILE_MISFIRE_EVENT, [ ('kind',       (E_MISSILE_MISFIRE,), E_MISSILE_MISFIRE),
+                                           ('player_oid', 'int', -1) ])
 class MissileMisfireEventMessage(GameMessage):
     def __init__(self, event=None):
         GameMessage.__init__(self, M_MISSILE_MISFIRE_EVENT)
-        if event:
-            event.set_message(self)
+        set_event(self, event)
         return
 
-def string_to_missile_misfire_event_message(string):
-    msg = EventMessage()
-    msg.from_string(string)
-    return msg
-    
+@schema_message(M_MISSILE_HIT_EVENT, [ ('kind',        (E_MISSILE_HIT,), E_MISSILE_HIT),
+                                       ('player_oid',  'int', -1),
+                                       ('missile_oid', 'int', -1),
+                                       ('target_oid',  'int', -1) ])
 class MissileHitEventMessage(GameMessage):
     def __init__(self, event=None):
         GameMessage.__init__(self, M_MISSILE_HIT_EVENT)
-        if event:
-            event.set_message(self)
+        set_event(self, event)
         return
 
-def string_to_missile_hit_event_message(string):
-    msg = EventMessage()
-    msg.from_string(string)
-    return msg
-    
+@schema_message(M_MISSILE_DYING_EVENT, [ ('kind',        (E_MISSILE_DYING,), E_MISSILE_DYING),
+                                         ('player_oid',  'int', -1),
+                                         ('missile_oid', 'int', -1) ])
 class MissileDyingEventMessage(GameMessage):
     def __init__(self, event=None):
         GameMessage.__init__(self, M_MISSILE_DYING_EVENT)
-        if event:
-            event.set_message(self)
+        set_event(self, event)
         return
-
-def string_to_missile_dying_event_message(string):
-    msg = EventMessage()
-    msg.from_string(string)
-    return msg
     
+EVENT_CLASSES = { M_EVENT:                 Event,
+                  M_MISSILE_FIRE_EVENT:    MissileFireEvent,
+                  M_MISSILE_MISFIRE_EVENT: MissileMisfireEvent,
+                  M_MISSILE_HIT_EVENT:     MissileHitEvent,
+                  M_MISSILE_DYING_EVENT:   MissileDyingEvent }
+
 def message_to_event(msg):
     code = msg.get_command()
-    if code == M_EVENT:
-        event = Event()
-    elif code == M_MISSILE_FIRE_EVENT:
-        event = MissileFireEvent()
-    elif code == M_MISSILE_MISFIRE_EVENT:
-        event = MissileMisfireEvent()
-    elif code == M_MISSILE_HIT_EVENT:
-        event = MissileHitEvent()
-    elif code == M_MISSILE_DYING_EVENT:
-        event = MissileDyingEvent()
-    else:
-        event = None
-    if event:
-        event.set_from_message(msg)
+    if not code in EVENT_CLASSES:
+        return None
+    event = EVENT_CLASSES[code]()
+    event.set_from_message(msg)
     return event
 
+def handle_event(engine, msg):
+    engine.add_event(message_to_event(msg))
+    return
+
+register_client_handler(M_EVENT,                 handle_event)
+register_client_handler(M_MISSILE_FIRE_EVENT,    handle_event)
+register_client_handler(M_MISSILE_MISFIRE_EVENT, handle_event)
+register_client_handler(M_MISSILE_HIT_EVENT,     handle_event)
+register_client_handler(M_MISSILE_DYING_EVENT,   handle_event)
+
 def event_to_message(event):
     kind = event.get_kind()
 
@@ -103,11 +103,5 @@ def event_to_message(event):
         msg = None
     return msg
 
-# 
-EVENT_MESSAGES = { M_EVENT:   string_to_event_message,
-                   M_MISSILE_FIRE_EVENT:    string_to_missile_fire_event_message,
-                   M_MISSILE_MISFIRE_EVENT: string_to_missile_misfire_event_message,
-                   M_MISSILE_HIT_EVENT:     string_to_missile_hit_event_message,
-                   M_MISSILE_DYING_EVENT:   string_to_missile_dying_event_message }
-
-
+EVENT_MESSAGES = message_decoders([ EventMessage, MissileFireEventMessage, MissileMisfireEventMessage,
+                                    MissileHitEventMessage, MissileDyingEventMessage ])
@@ -0,0 +1,61 @@
+#
+# Fields that change at a known rate between updates.
+#
+# With EXTRAPOLATION agreed, the client advances them at every TICK,
+# and the server leaves them out of updates while the client's value
+# stays within EXTRAPOLATION_TOLERANCE of its own.  A new value is only
+# sent when the rate changes, or the client has drifted.
+#
+# The rules work on a dictionary of fields: the data of an update
+# message on the server, an object's __dict__ on the client.
+#
+from common.object import STATE_DYING, DYING_TIME
+
+# largest difference between the server's value and the client's
+EXTRAPOLATION_TOLERANCE = 0.01
+
+def dying_rate(fields):
+    if fields['state'] == STATE_DYING:
+        return 1. / DYING_TIME
+    return 0.
+
+def missile_mana_rate(fields):
+    return fields['missile_mana_recharge_rate']
+
+def move_mana_rate(fields):
+    """recharges while standing still, moving costs depend on the server"""
+    if fields['speed'] == 0.:
+        return fields['move_mana_recharge_rate']
+    return None
+
+# (field, rate(fields) per second or None if unknown, field holding its maximum or None for 1.0)
+EXTRAPOLATED_FIELDS = [ ('dying_percent', dying_rate,        None),
+                        ('missile_mana',  missile_mana_rate, 'missile_mana_max'),
+                        ('move_mana',     move_mana_rate,    'move_mana_max') ]
+EXTRAPOLATED_KEYS = frozenset([ key for (key, rate, maximum) in EXTRAPOLATED_FIELDS ])
+
+def extrapolate(fields, seconds):
+    """Advances the extrapolated fields present in fields by seconds, in place.
+       Returns True if any of them changed."""
+    moved = False
+    for (key, rate, maximum) in EXTRAPOLATED_FIELDS:
+        if not key in fields:
+            continue
+        slope = rate(fields)
+        if not slope:
+            continue
+        if maximum is None:
+            top = 1.0
+        else:
+            top = fields[maximum]
+        value = min(max(fields[key] + slope * seconds, 0.), top)
+        if value != fields[key]:
+            fields[key] = value
+            moved = True
+    return moved
+
+def is_extrapolated(key, previous, value):
+    """True if the client's previous value of key is close enough to value"""
+    if not key in EXTRAPOLATED_KEYS or previous is None:
+        return False
+    return abs(previous - value) <= EXTRAPOLATION_TOLERANCE
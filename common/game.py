@@ -104,6 +104,19 @@ class GameData:
             del self.objects[oid]
         return
     
+    def apply_delta(self, oid, fields):
+        """
+        Merges changed fields into the object already stored.
+        Returns the object, or None if oid is unknown.
+        """
+        obj = self.get_object(oid)
+        if obj is None:
+            return None
+        obj.apply_delta(fields)
+        if obj.is_dead():
+            del self.objects[oid]
+        return obj
+    
     def remove_object(self, obj):
         oid = obj.get_oid()
         del self.objects[oid]
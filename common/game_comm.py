@@ -1,11 +1,15 @@
 #
 # Don't change this file
 #
-import socket, errno, logging
+import socket, errno, logging, re, collections, zlib, json, time, struct
 from common.game_message import *
 from common.object_message import *
 from common.command_message import *
 from common.event_message import *
+from common.snapshot_message import *
+from common.object_codec import build_object_codecs
+from common.message_schema import build_message_codecs
+from common.transport import LOCAL_PREFIXES
 
 WINDOWS_EAGAIN = 10035
 
@@ -22,14 +26,186 @@ def setup_message_types():
         ALL_MESSAGES[k] = COMMAND_MESSAGES[k]
     for k in EVENT_MESSAGES:
         ALL_MESSAGES[k] = EVENT_MESSAGES[k]
+    for k in SNAPSHOT_MESSAGES:
+        ALL_MESSAGES[k] = SNAPSHOT_MESSAGES[k]
     ALL_MESSAGE_CODES = ALL_MESSAGES.keys()
     return
 setup_message_types()
 
+# Frame sent, uncompressed, by a writer that starts compressing.
+# Every byte after it in that direction is a zlib stream.
+M_START_COMPRESSION = "START_COMPRESSION"
+# Frame sent, with a text header, by a writer that starts using compact
+# headers.  Every frame after it in that direction has a compact header.
+M_START_COMPACT = "START_COMPACT"
+# Frame whose body is a channel id, in ascii digits.  Every frame after it
+# in that direction belongs to that channel's match, until the next one.
+# Frames before the first belong to channel 0, the match of the login.
+M_CHANNEL = "CHANNEL"
+# Frame sent by a writer that starts packing message bodies by their
+# schema.  Every frame after it in that direction whose message type
+# has a fixed size schema has a binary body.
+M_START_BINARY = "START_BINARY"
+# frames handled by the reader itself, never returned as messages
+MARKER_CODES = [ M_START_COMPRESSION, M_START_COMPACT, M_CHANNEL, M_HEARTBEAT, M_START_BINARY ]
+
+# Stable small integer ids of the message codes, for compact frame headers.
+# The id of a code is its index here: only ever append to this list.
+MESSAGE_CODES = [ M_ECHO, M_BROADCAST, M_LOGIN,
+                  M_REQUEST_DUAL, M_WAIT_FOR_DUAL, M_REQUEST_SINGLE, M_WAIT_FOR_SINGLE,
+                  M_REQUEST_TOURNAMENT, M_WAIT_FOR_TOURNAMENT, M_REQUEST_AI, M_WAIT_FOR_AI,
+                  M_REQUEST_VIEW, M_WAIT_FOR_VIEW, M_GAME_STARTING, M_GAME_OVER,
+                  M_PLAYER_UPDATE, M_WALL_UPDATE, M_NPC_UPDATE, M_MISSILE_UPDATE, M_OBJECT_DELTA,
+                  M_REQUEST_PLAYER_OID, M_SET_PLAYER_SPEED, M_SET_PLAYER_DIRECTION,
+                  M_SET_MISSILE_RANGE, M_SET_MISSILE_DIRECTION, M_SET_MISSILE_POWER,
+                  M_FIRE_MISSILE, M_PLAYER_OID,
+                  M_EVENT, M_MISSILE_FIRE_EVENT, M_MISSILE_MISFIRE_EVENT, M_MISSILE_HIT_EVENT,
+                  M_MISSILE_DYING_EVENT,
+                  M_SNAPSHOT, M_TICK, M_START_COMPRESSION, M_CHANNEL, M_HAVE_MAP,
+                  M_HEARTBEAT, M_START_BINARY, M_CLOSE_CHANNEL ]
+MESSAGE_IDS = {}
+MESSAGE_ID_BYTES = {}
+def setup_message_ids():
+    """ids below 128 take one byte, the rest two, with the top bit of the first set"""
+    for i in range(len(MESSAGE_CODES)):
+        MESSAGE_IDS[MESSAGE_CODES[i]] = i
+        if i < 0x80:
+            MESSAGE_ID_BYTES[MESSAGE_CODES[i]] = chr(i)
+        else:
+            MESSAGE_ID_BYTES[MESSAGE_CODES[i]] = chr(0x80 | (i >> 8)) + chr(i & 0xff)
+    return
+setup_message_ids()
+
+def get_message_id(code):
+    """returns the compact header id of code, or None"""
+    if not code in MESSAGE_IDS:
+        return None
+    return MESSAGE_IDS[code]
+
+####################################################################
+
+# Optional features, agreed on by client and server in the LOGIN
+# exchange.  The client offers its list in the request, the server
+# answers with the ones it accepts.  A peer that sends no list gets
+# the plain JSON protocol.
+C_BINARY_OBJECTS   = "BINARY_OBJECTS"    # struct-packed object update and delta messages
+C_QUANTIZED_COORDS = "QUANTIZED_COORDS"  # 16 bit x, y, w, h in binary object updates
+C_DELTA_UPDATES    = "DELTA_UPDATES"     # OBJECT_DELTA messages after the first full update
+C_SNAPSHOTS        = "SNAPSHOTS"         # one SNAPSHOT frame per server tick
+C_COMPRESSION      = "ZLIB"              # zlib stream compression in both directions
+C_PIPELINED_LOGIN  = "PIPELINED_LOGIN"   # the LOGIN request carries the mode request
+C_TICKS            = "TICKS"             # a TICK message starts each server frame
+C_COMPACT_HEADERS  = "COMPACT_HEADERS"   # binary message id and size in place of "CODE SIZE "
+C_SESSIONS         = "SESSIONS"          # after GAME_OVER the login stays, for the next mode request
+C_CHANNELS         = "CHANNELS"          # CHANNEL frames carry several matches on one connection
+C_MISSILE_SPAWNS   = "MISSILE_SPAWNS"    # missiles sent at spawn and end only, with TICKS the client moves them
+C_EXTRAPOLATION    = "EXTRAPOLATION"     # mana and dying_percent left out while, with TICKS, the client advances them
+C_MAP_CACHE        = "MAP_CACHE"         # GAME_STARTING has a map hash, walls only follow a HAVE_MAP without them
+C_HEARTBEATS       = "HEARTBEATS"        # HEARTBEAT when quiet, a peer silent for its idle timeout is gone
+C_BINARY_MESSAGES  = "BINARY_MESSAGES"   # struct-packed bodies for the other messages with a fixed size schema
+
+SUPPORTED_CAPABILITIES = [ C_BINARY_OBJECTS, C_QUANTIZED_COORDS, C_DELTA_UPDATES, C_SNAPSHOTS,
+                           C_COMPRESSION, C_PIPELINED_LOGIN, C_TICKS, C_COMPACT_HEADERS, C_SESSIONS,
+                           C_CHANNELS, C_MISSILE_SPAWNS, C_EXTRAPOLATION, C_MAP_CACHE, C_HEARTBEATS,
+                           C_BINARY_MESSAGES ]
+# offered unless the caller chooses otherwise, quantizing is opt-in
+DEFAULT_CAPABILITIES = [ C_BINARY_OBJECTS, C_DELTA_UPDATES, C_SNAPSHOTS, C_COMPRESSION,
+                         C_PIPELINED_LOGIN, C_TICKS, C_COMPACT_HEADERS, C_SESSIONS, C_CHANNELS,
+                         C_MISSILE_SPAWNS, C_EXTRAPOLATION, C_MAP_CACHE, C_HEARTBEATS, C_BINARY_MESSAGES ]
+
+# compression costs more CPU than it saves on these
+LOOPBACK_HOSTS = [ "127.0.0.1", "localhost", "::1" ]
+
+def default_capabilities(host=None):
+    """DEFAULT_CAPABILITIES, without compression for a server on this machine"""
+    if host in LOOPBACK_HOSTS or (host and host.startswith(LOCAL_PREFIXES)):
+        return [ c for c in DEFAULT_CAPABILITIES if c != C_COMPRESSION ]
+    return list(DEFAULT_CAPABILITIES)
+
+def uses_missile_spawns(capabilities):
+    """True if live missiles are moved by the client: the server sends
+       them at spawn and end only, the TICK times tell how far they flew"""
+    return C_MISSILE_SPAWNS in capabilities and C_TICKS in capabilities
+
+def uses_extrapolation(capabilities):
+    """True if the client advances the fields in common.extrapolation,
+       from one TICK time to the next"""
+    return C_EXTRAPOLATION in capabilities and C_TICKS in capabilities
+
+####################################################################
+
+COMPRESSION_LEVEL = 6
+
+# what the preset dictionary is made of.  Both ends must prime their
+# streams with the same bytes, so these are frozen: they are not read
+# from the message tables, which grow with every new message type.
+# Changing them needs a new compression capability.
+PRESET_CODES = ( 'BROADCAST', 'CLOSE_CHANNEL', 'ECHO', 'FIRE_MISSILE', 'GAME_OVER',
+                 'GAME_STARTING', 'HAVE_MAP', 'HEARTBEAT', 'LOGIN', 'MISSILE_UPDATE',
+                 'M_EVENT', 'M_MISSILE_DYING_EVENT', 'M_MISSILE_FIRE_EVENT',
+                 'M_MISSILE_HIT_EVENT', 'M_MISSILE_MISFIRE_EVENT', 'NPC_UPDATE',
+                 'OBJECT_DELTA', 'PLAYER_OID', 'PLAYER_UPDATE', 'REQUEST_AI',
+                 'REQUEST_DUAL', 'REQUEST_PLAYER_OID', 'REQUEST_SINGLE',
+                 'REQUEST_TOURNAMENT', 'REQUEST_VIEW', 'SET_MISSILE_DIRECTION',
+                 'SET_MISSILE_POWER', 'SET_MISSILE_RANGE', 'SET_PLAYER_DIRECTION',
+                 'SET_PLAYER_SPEED', 'TICK', 'WAIT_FOR_AI', 'WAIT_FOR_DUAL',
+                 'WAIT_FOR_SINGLE', 'WAIT_FOR_TOURNAMENT', 'WAIT_FOR_VIEW', 'WALL_UPDATE' )
+PRESET_KEYS = ( 'oid', 'x', 'y', 'w', 'h', 'dx', 'dy', 'distance', 'speed', 'state',
+                'health', 'max_health', 'dying_percent', 'range', 'power', 'player_oid',
+                'hit_max_range', 'oid', 'x', 'y', 'w', 'h', 'dx', 'dy', 'distance',
+                'speed', 'state', 'health', 'max_health', 'dying_percent', 'experience',
+                'missile_range', 'missile_dx', 'missile_dy', 'missile_power', 'missile_mana',
+                'missile_mana_recharge_rate', 'missile_mana_max', 'move_mana',
+                'move_mana_recharge_rate', 'move_mana_max' )
+
+def build_preset_dictionary():
+    """Text that both ends run through their zlib streams before the first
+       frame, so that the keys repeated in every message compress well from
+       the start.  The most common strings go last, nearest to the data."""
+    words = [ '{"data": {', '"command": ', '"SNAPSHOT": ' ]
+    for k in PRESET_CODES:
+        words.append('"%s" %s' % (k, k))
+    for key in PRESET_KEYS:
+        words.append('"%s": 0.0, ' % (key))
+    return "".join(words)
+PRESET_DICTIONARY = build_preset_dictionary()
+
 ####################################################################
 
 E_0BYTES  = "0 Bytes Read"
 E_BAD_CMD = "Bad Command"
+E_FRAME_TOO_LARGE = "Frame Too Large"
+
+# largest chunk requested from the socket by a single recv_into()
+RECV_SIZE = 65536
+# initial size of the receive buffer, grown only for frames that don't fit
+BUFFER_SIZE = 4 * RECV_SIZE
+# largest message body accepted from the peer
+MAX_FRAME_SIZE = 1048576
+# longest run of bytes that may precede a complete "CODE SIZE " header
+MAX_HEADER_SIZE = 128
+# with HEARTBEATS, seconds without writing before a HEARTBEAT is written
+HEARTBEAT_INTERVAL = 2.0
+# with HEARTBEATS, seconds without reading before the peer is taken for gone
+IDLE_TIMEOUT = 10.0
+
+# "CODE SIZE BODY": whitespace, the code, whitespace, ascii digits, one separator
+FRAME_HEADER = re.compile(r'\s*(\S+)\s\s*(\d+)\D')
+
+# compact header: the message id in one or two bytes, then the body size
+# in 7 bit groups, least significant first, the top bit set on all but the last
+MAX_SIZE_BYTES = 4
+
+def encode_compact_header(code, size):
+    header = MESSAGE_ID_BYTES[code]
+    while size >= 0x80:
+        header += chr(0x80 | (size & 0x7f))
+        size >>= 7
+    return header + chr(size)
+
+# phases of the frame parser
+PHASE_HEADER = 0   # waiting for a complete "CODE SIZE " header
+PHASE_BODY   = 1   # header parsed, waiting for SIZE bytes of body
 
 class GameCommException(Exception):
     def __init__(self, msg):
@@ -40,7 +216,10 @@ class GameCommException(Exception):
         return self.msg == E_0BYTES
         
     def is_bad_command(self):
-        return self.msg == E_BAD_CMD
+        return self.msg.startswith(E_BAD_CMD)
+        
+    def is_frame_too_large(self):
+        return self.msg == E_FRAME_TOO_LARGE
         
     def get_msg(self):
         return self.msg
@@ -51,155 +230,696 @@ class GameCommException(Exception):
 ####################################################################        
 
 class GameComm:
+    """
+    Reads and writes framed GameMessages over sock: a non-blocking
+    socket, or any transport from common.transport.  Only recv_into()
+    and send() are used.
+    """
 
-    def __init__(self, sock):
+    def __init__(self, sock, capabilities=None):
         self.logger = logging.getLogger('GameComm')
         self.ok = True
         self.sock = sock
+        if capabilities is None:
+            capabilities = DEFAULT_CAPABILITIES
+        self.offered_capabilities = list(capabilities) # features this end is willing to use
+        self.peer_capabilities = []  # features offered by the peer's LOGIN request
+        self.capabilities = set()    # features in use on this connection
+        self.codecs = {}             # binary codecs in use, by message code
+        self.object_codecs = build_object_codecs() # decode-to-object for JSON object updates
+        # schemas of the other messages with a binary body, object updates have their codecs
+        self.message_codecs = build_message_codecs(self.object_codecs)
+        self.object_lookup = None    # lookup(oid) of objects to decode into, for channel_in
+        self.tick = -1               # latest TICK read on channel_in, the tick of the frames that follow it
+        self.channel_in = 0          # channel of the frames being read, see M_CHANNEL
+        self.channel_out = 0         # channel of the frames being written
+        self.channel_lookups = {}    # object lookup of each channel, see set_object_lookup()
+        self.channel_ticks = {}      # latest TICK read on each channel but channel_in
+        self.compact_in = False      # True once the peer sent M_START_COMPACT
+        self.compact_out = False     # True once this end sent M_START_COMPACT
+        self.binary_in = False       # True once the peer sent M_START_BINARY
+        self.binary_out = False      # True once this end sent M_START_BINARY
+        self.compressor = None       # zlib stream for bytes written, once compression starts
+        self.decompressor = None     # zlib stream for bytes read, once the peer starts compressing
+        self.preset_skip = 0         # decompressed preset dictionary bytes still to discard
+        self.raw = bytearray(RECV_SIZE)  # compressed bytes, before they are inflated into self.buffer
+        self.raw_view = memoryview(self.raw)
+        self.bytes_in = 0            # frame bytes read
+        self.wire_bytes_in = 0       # socket bytes read
+        self.bytes_out = 0           # frame bytes written
+        self.wire_bytes_out = 0      # socket bytes written
+        self.outgoing = bytearray()  # bytes written that the socket has not taken yet
+        self.sized_frames = {}       # id(msg) -> (msg, frame) encoded by frame_size(), for the next write
+        self.last_read = time.time()   # when bytes last arrived
+        self.last_write = time.time()  # when frames were last written
+        self.heartbeat_interval = HEARTBEAT_INTERVAL
+        self.idle_timeout = IDLE_TIMEOUT
+        self.buffer = bytearray(BUFFER_SIZE) # receive buffer, reused for every frame
+        self.view = memoryview(self.buffer)  # slices of the buffer, without copies
+        self.pos = 0              # offset of the first unparsed byte in self.buffer
+        self.end = 0              # offset one past the last received byte in self.buffer
+        self.pending = collections.deque() # parsed messages not yet returned by read_mesg()
+        self.phase = PHASE_HEADER # parser state, kept between calls on a non-blocking socket
+        self.code = None          # code of the frame being read
+        self.size = 0             # body size of the frame being read
         return
 
     def __nonzero__(self):
         return self.ok
         
-    def _read_int(self):
-        """skips whitespace, reads ascii digits, converts to int.  throws away first non-digit character after"""
-        n = 0
-        first = True
-        while True:
-            try:
-                c = self.sock.recv(1)
-                if len(c) == 0:
-                    self.ok = False
-                    raise GameCommException(E_0BYTES)
-                    break
-                if first and c.isspace():
-                    continue
-                elif c >= '0' and c <= '9':
-                    n = n * 10 + ord(c) - ord('0')
-                    first = False
-                else:
-                    break
-            except socket.error as e:
-                if e.errno == errno.EAGAIN or e.errno == WINDOWS_EAGAIN:
-                    self.logger.warning("_read_int: %s", e.strerror)
-                else:
-                    raise e
-        return n
-        
-    def _read_word(self):
-        """skips whitespace, reads ascii characters, builds a string.  throws away first whitespace character after"""
-        word = ""
-        first = True
+    def get_capabilities(self):
+        return self.capabilities
+
+    def has_capability(self, capability):
+        return capability in self.capabilities
+
+    def enable_capabilities(self, capabilities):
+        """Switches the connection to the given features.
+           Called during the LOGIN exchange, or directly if both ends
+           are configured alike."""
+        self.capabilities = set([ c for c in capabilities if c in SUPPORTED_CAPABILITIES ])
+        if C_BINARY_OBJECTS in self.capabilities:
+            self.codecs = build_object_codecs(C_QUANTIZED_COORDS in self.capabilities)
+        else:
+            self.codecs = {}
+        self.logger.info('enable_capabilities: %s', sorted(self.capabilities))
+        if C_COMPACT_HEADERS in self.capabilities and not self.compact_out:
+            self._write_frames([ self._frame_header(M_START_COMPACT, 0) ])
+            self.compact_out = True
+        if C_BINARY_MESSAGES in self.capabilities and not self.binary_out:
+            self._write_frames([ self._frame_header(M_START_BINARY, 0) ])
+            self.binary_out = True
+        if C_COMPRESSION in self.capabilities and self.compressor is None:
+            self._start_compressing()
+        return
+
+    def set_object_lookup(self, lookup, channel=0):
+        """With lookup set, object updates are decoded straight into
+           the object lookup(oid) returns (or a new one if it returns None),
+           and the message carries that object instead of a data dictionary.
+           Objects are updated in place as read_mesgs() parses, so a message
+           may already show a later update of its object from the same batch.
+           An object stamped with a later tick than the update is left alone,
+           the update gets a new object, for the engine to drop as stale.
+           Objects decoded into are stamped with the tick of the update.
+           None goes back to plain messages.
+           Each channel has its own lookup, for the engine of its match."""
+        self.channel_lookups[channel] = lookup
+        if channel == self.channel_in:
+            self.object_lookup = lookup
+        return
+
+    def close_channel(self, channel):
+        """Forgets the lookup and latest TICK of channel, once it is closed."""
+        self.set_object_lookup(None, channel)
+        del self.channel_lookups[channel]
+        if channel in self.channel_ticks:
+            del self.channel_ticks[channel]
+        return
+
+    def get_object_lookup(self, channel=0):
+        if not channel in self.channel_lookups:
+            return None
+        return self.channel_lookups[channel]
+
+    def get_channel_in(self):
+        return self.channel_in
+
+    def _switch_channel_in(self, channel):
+        """the peer sent M_CHANNEL, the frames that follow are for channel"""
+        self.channel_ticks[self.channel_in] = self.tick
+        self.channel_in = channel
+        self.tick = self.channel_ticks.pop(channel, -1)
+        self.object_lookup = self.channel_lookups.get(channel)
+        return
+
+    def get_bytes_in(self):
+        return self.bytes_in
+    def get_wire_bytes_in(self):
+        return self.wire_bytes_in
+    def get_bytes_out(self):
+        return self.bytes_out
+    def get_wire_bytes_out(self):
+        return self.wire_bytes_out
+
+    def set_heartbeat(self, interval, idle_timeout):
+        """seconds between HEARTBEATs, and of silence before the peer is gone"""
+        self.heartbeat_interval = interval
+        self.idle_timeout = idle_timeout
+        return
+
+    def get_idle_time(self, now=None):
+        """seconds since bytes last arrived"""
+        if now is None:
+            now = time.time()
+        return now - self.last_read
+
+    def is_timed_out(self, now=None):
+        """True if HEARTBEATS was agreed, and the peer has sent nothing
+           for longer than the idle timeout"""
+        return C_HEARTBEATS in self.capabilities and self.get_idle_time(now) > self.idle_timeout
+
+    def heartbeat(self, now=None):
+        """Writes a HEARTBEAT if HEARTBEATS was agreed, and nothing has
+           been written for the heartbeat interval.  Call it regularly.
+           Returns True if one was written.  A socket error fails the GameComm."""
+        if not self.ok or not C_HEARTBEATS in self.capabilities:
+            return False
+        if now is None:
+            now = time.time()
+        if now - self.last_write < self.heartbeat_interval:
+            return False
+        try:
+            return self.write_mesg(HeartbeatMessage())
+        except socket.error as e:
+            self.logger.info("heartbeat: %s", e)
+            self.ok = False
+        return False
+
+    def close(self):
+        """Closes the transport and frees the buffers, for a connection
+           that is given up on.  The GameComm fails from then on."""
+        self.ok = False
+        self.outgoing = bytearray()
+        self.sized_frames = {}
+        self.pending.clear()
+        self.buffer = bytearray()
+        self.view = memoryview(self.buffer)
+        self.pos = self.end = 0
+        self.phase = PHASE_HEADER
+        self.compressor = None
+        self.decompressor = None
+        try:
+            self.sock.close()
+        except socket.error as e:
+            self.logger.info("close: %s", e)
+        return
+
+    def get_compression_ratio(self):
+        """Returns (read ratio, write ratio): frame bytes per socket byte, 1.0 when uncompressed."""
+        read_ratio = 1.0
+        if self.wire_bytes_in > 0:
+            read_ratio = float(self.bytes_in) / self.wire_bytes_in
+        write_ratio = 1.0
+        if self.wire_bytes_out > 0:
+            write_ratio = float(self.bytes_out) / self.wire_bytes_out
+        return read_ratio, write_ratio
+
+    def _start_compressing(self):
+        """tells the peer that the rest of this direction is compressed, then primes
+           the stream with the preset dictionary."""
+        self._write_frames([ self._frame_header(M_START_COMPRESSION, 0) ])
+        self.compressor = zlib.compressobj(COMPRESSION_LEVEL)
+        preset = self.compressor.compress(PRESET_DICTIONARY) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.wire_bytes_out += len(preset)
+        self._send_or_queue(preset)
+        return
+
+    def _start_decompressing(self):
+        """the peer sent M_START_COMPRESSION, inflate everything after it"""
+        self.decompressor = zlib.decompressobj()
+        self.preset_skip = len(PRESET_DICTIONARY)
+        tail = self.view[self.pos:self.end].tobytes()
+        self.bytes_in -= len(tail)
+        self.end = self.pos
+        self._append(self.decompressor.decompress(tail))
+        return
+
+    def _negotiate_read(self, msg):
+        """tracks capabilities from a LOGIN message received from the peer"""
+        if msg.get_request():
+            self.peer_capabilities = msg.get_capabilities()
+        elif msg.get_result():
+            self.enable_capabilities(msg.get_capabilities())
+        return
+
+    def _negotiate_write(self, msg):
+        """fills in capabilities on a LOGIN message to be sent to the peer.
+           returns the capabilities to enable once it is sent, or None."""
+        if msg.get_request():
+            msg.set_capabilities(self.offered_capabilities)
+            return None
+        accepted = [ c for c in self.peer_capabilities if c in self.offered_capabilities ]
+        if not msg.get_result():
+            accepted = []
+        msg.set_capabilities(accepted)
+        if msg.get_result():
+            return accepted
+        return None
+
+    def _make_room(self, needed=RECV_SIZE):
+        """moves unparsed bytes to the front of the buffer, growing it only
+           if a single frame needs more than needed bytes of free space"""
+        unparsed = self.end - self.pos
+        if self.pos > 0:
+            self.view[0:unparsed] = self.view[self.pos:self.end]
+            self.pos = 0
+            self.end = unparsed
+        if len(self.buffer) - unparsed < needed:
+            grown = bytearray(max(2 * len(self.buffer), unparsed + needed))
+            grown[0:unparsed] = self.view[0:unparsed]
+            self.buffer = grown
+            self.view = memoryview(self.buffer)
+        return
+
+    def _append(self, data):
+        """copies inflated bytes to the end of the buffer"""
+        if self.preset_skip > 0:
+            skip = min(self.preset_skip, len(data))
+            self.preset_skip -= skip
+            data = data[skip:]
+        if len(self.buffer) - self.end < len(data):
+            self._make_room(len(data))
+        self.view[self.end:self.end + len(data)] = data
+        self.end += len(data)
+        self.bytes_in += len(data)
+        return
+
+    def _fill_buffer_compressed(self):
+        """receives one chunk from the socket, and inflates it into the buffer.
+           returns False if the socket has no data ready."""
+        try:
+            n = self.sock.recv_into(self.raw_view, RECV_SIZE)
+        except socket.error as e:
+            if e.errno == errno.EAGAIN or e.errno == WINDOWS_EAGAIN:
+                return False
+            raise e
+        if n == 0:
+            self.ok = False
+            raise GameCommException(E_0BYTES)
+        self.wire_bytes_in += n
+        self.last_read = time.time()
+        self._append(self.decompressor.decompress(buffer(self.raw, 0, n)))
+        return True
+
+    def _fill_buffer(self):
+        """receives one large chunk from the socket directly into the buffer.
+           returns False if the socket has no data ready."""
+        if self.decompressor is not None:
+            return self._fill_buffer_compressed()
+        if len(self.buffer) - self.end < RECV_SIZE:
+            self._make_room()
+        try:
+            n = self.sock.recv_into(self.view[self.end:], RECV_SIZE)
+        except socket.error as e:
+            if e.errno == errno.EAGAIN or e.errno == WINDOWS_EAGAIN:
+                return False
+            raise e
+        if n == 0:
+            self.ok = False
+            raise GameCommException(E_0BYTES)
+        self.end += n
+        self.bytes_in += n
+        self.wire_bytes_in += n
+        self.last_read = time.time()
+        return True
+
+    def _decode_body(self, code, start, stop):
+        """returns the GameMessage encoded in self.buffer[start:stop]"""
+        if code in self.codecs:
+            if self.object_lookup is not None:
+                return self.codecs[code].decode_object(self.view[start:stop], self.object_lookup, self.tick)
+            return self.codecs[code].decode(self.view[start:stop])
+        if self.object_lookup is not None and code in self.object_codecs:
+            data = json.loads(self.view[start:stop].tobytes())['data']
+            return self.object_codecs[code].decode_json_object(data, self.object_lookup, self.tick)
+        if code == M_SNAPSHOT:
+            return self._decode_snapshot(start, stop)
+        if self.binary_in and code in self.message_codecs:
+            msg = self.message_codecs[code].decode(self.view[start:stop])
+        elif code in ALL_MESSAGES:
+            # json needs a str, so this is the only copy made of the body
+            msg = ALL_MESSAGES[code](self.view[start:stop].tobytes())
+        else:
+            self.ok = False
+            raise GameCommException(E_BAD_CMD + ":" + code)
+        if code == M_TICK:
+            self.tick = msg.get_tick()
+        return msg
+
+    def _decode_frame(self, code, start, stop):
+        """_decode_body(), with a body that does not decode as a bad command.
+           The connection stays usable: the frame's size was known."""
+        try:
+            return self._decode_body(code, start, stop)
+        except (ValueError, KeyError, TypeError, IndexError, struct.error) as e:
+            raise GameCommException(E_BAD_CMD + ": malformed %s: %s" % (code, e))
+
+    def _read_compact_header(self, buf, pos, end):
+        """returns (code, size, position after the header), or None if incomplete"""
+        if pos >= end:
+            return None
+        mid = buf[pos]
+        pos += 1
+        if mid & 0x80:
+            if pos >= end:
+                return None
+            mid = ((mid & 0x7f) << 8) | buf[pos]
+            pos += 1
+        if mid >= len(MESSAGE_CODES):
+            self.ok = False
+            raise GameCommException(E_BAD_CMD + ": message id %d" % (mid))
+        size = 0
+        shift = 0
         while True:
-            try:
-                c = self.sock.recv(1)
-                if len(c) == 0:
-                    self.ok = False
-                    raise GameCommException(E_0BYTES)
+            if pos >= end:
+                return None
+            byte = buf[pos]
+            pos += 1
+            size |= (byte & 0x7f) << shift
+            if not byte & 0x80:
+                break
+            shift += 7
+            if shift >= 7 * MAX_SIZE_BYTES:
+                self.ok = False
+                raise GameCommException(E_BAD_CMD + ": malformed header")
+        return MESSAGE_CODES[mid], size, pos
+
+    def _read_header(self, buf, pos, end):
+        """returns (code, size, position after the header), or None if incomplete"""
+        if self.compact_in:
+            return self._read_compact_header(buf, pos, end)
+        match = FRAME_HEADER.match(buf, pos, end)
+        if match is None:
+            return None
+        code, size = match.groups()
+        return str(code), int(size), match.end()
+
+    def _read_channel(self, start, stop):
+        """returns the channel id in the body of an M_CHANNEL frame"""
+        digits = self.view[start:stop].tobytes()
+        if not digits.isdigit():
+            self.ok = False
+            raise GameCommException(E_BAD_CMD + ": malformed channel")
+        return int(digits)
+
+    def _decode_snapshot(self, start, stop):
+        """returns the SnapshotMessage whose inner frames are in self.buffer[start:stop]"""
+        snapshot = SnapshotMessage()
+        pos = start
+        while pos < stop:
+            header = self._read_header(self.buffer, pos, stop)
+            if header is None:
+                self.ok = False
+                raise GameCommException(E_BAD_CMD + ": malformed snapshot")
+            code, size, pos = header
+            end = pos + size
+            if end > stop:
+                self.ok = False
+                raise GameCommException(E_BAD_CMD + ": truncated snapshot")
+            snapshot.add_message(self._decode_body(code, pos, end))
+            pos = end
+        return snapshot
+
+    def _parse_frames(self, msgs):
+        """advances the parser through the buffer, appending a GameMessage to
+           msgs for every complete "CODE SIZE BODY" frame.  parser state is
+           kept in locals while looping, and saved when more data is needed."""
+        # checked once per batch, rather than once per message
+        verbose = self.logger.isEnabledFor(logging.INFO)
+        buf, view, pos, end = self.buffer, self.view, self.pos, self.end
+        phase, code, size = self.phase, self.code, self.size
+        compact = self.compact_in
+        channel = self.channel_in
+        try:
+            while True:
+                if phase == PHASE_HEADER:
+                    if compact:
+                        header = self._read_compact_header(buf, pos, end)
+                        if header is None:
+                            break
+                        code, size, pos = header
+                    else:
+                        match = FRAME_HEADER.match(buf, pos, end)
+                        if match is None:
+                            if end - pos > MAX_HEADER_SIZE:
+                                self.ok = False
+                                raise GameCommException(E_BAD_CMD + ": malformed header")
+                            break
+                        code, size = match.groups()
+                        code = str(code)
+                        size = int(size)
+                        pos = match.end()
+                    if size > MAX_FRAME_SIZE:
+                        self.ok = False
+                        raise GameCommException(E_FRAME_TOO_LARGE)
+                    phase = PHASE_BODY
+
+                if end - pos < size:
                     break
-                if first and c.isspace():
+                if code in MARKER_CODES:
+                    phase = PHASE_HEADER
+                    if code == M_CHANNEL:
+                        channel = self._read_channel(pos, pos + size)
+                        pos += size
+                        self._switch_channel_in(channel)
+                        continue
+                    pos += size
+                    if code == M_START_COMPACT:
+                        compact = self.compact_in = True
+                    elif code == M_START_BINARY:
+                        self.binary_in = True
+                    elif code == M_START_COMPRESSION:
+                        self.pos = pos
+                        self._start_decompressing()
+                        buf, view, pos, end = self.buffer, self.view, self.pos, self.end
                     continue
-                elif (not first) and c.isspace():
-                    break
-                else:
-                    word += c
-                    first = False
-            except socket.error as e:
-                if e.errno == errno.EAGAIN or e.errno == WINDOWS_EAGAIN:
-                    self.logger.warning("_read_word: %s", e.strerror)
-                else:
-                    raise e
-        return word
-        
-    def _read_nbytes(self, n):
-        """reads n bytes"""
-        nread = 0
-        msg = ""
-        while n > nread:
-            try:
-                msg0 = self.sock.recv(n-nread)
-                if len(msg0) == 0:
-                    self.ok = False
-                    raise GameCommException(E_0BYTES)
-                    break
-                nread += len(msg0)
-                msg += msg0
-            except socket.error as e:
-                if e.errno == errno.EAGAIN or e.errno == WINDOWS_EAGAIN:
-                    self.logger.warning("_read_nbytes: %s", e.strerror)
-                else:
-                    raise e
-        self.logger.debug("'" + msg + "'" + str(len(msg)) + " " + str(n))
-        return msg
+                # past the frame first, so that a malformed body is dropped alone
+                pos += size
+                phase = PHASE_HEADER
+                msg = self._decode_frame(code, pos - size, pos)
+                if channel:
+                    msg.set_channel(channel)
+                if verbose:
+                    self.logger.info('read_mesg: msg: %s', msg)
+                msgs.append(msg)
+                if code == M_LOGIN:
+                    # frames that follow may already use the agreed encoding
+                    self.pos = pos
+                    self._negotiate_read(msg)
+                    buf, view, pos, end = self.buffer, self.view, self.pos, self.end
+        finally:
+            self.pos, self.phase, self.code, self.size = pos, phase, code, size
+        return
 
-    def read_mesg(self):
-        """Reads one GameMessage object from the socket.
-           Returns the object.
-           On error, returns
+    def read_mesgs(self):
+        """Reads all complete GameMessage objects available from the socket,
+           with one large recv() per batch instead of one per header byte.
+           Returns a list of at least one message.
+           A partially received frame is kept, and finished by a later call.
+           On error, the last message of the list is
+             M_EAGAIN if a non-blocking socket has no complete message yet
              M_NONE if the GameComm has previously failed
              M_CLOSED if a 0 read occurs
-             M_BAD_COMMAND if an unknown message type is received
+             M_BAD_COMMAND if an unknown message type, oversized frame or malformed body is received
         """
+        msgs = list(self.pending)
+        self.pending.clear()
         try:
-            msg = GameMessage()
             if not self.ok:
-                return msg
-            
-            code = self._read_word()
-            self.logger.debug('read_mesg: code: %s', code)
-            size = self._read_int()
-            self.logger.debug('read_mesg: size: %d', size)
-            string = self._read_nbytes(size)
-            self.logger.debug('read_mesg: string: %s', string)
-
-            if code in ALL_MESSAGES:
-                msg = ALL_MESSAGES[code](string)
-                self.logger.info('read_mesg: msg: %s', msg)
-            else:
-                self.ok = False
-                raise GameCommException(E_BAD_CMD + ":" + code)
+                if not msgs:
+                    msgs.append(GameMessage())
+                return msgs
 
-            return msg
+            self._parse_frames(msgs)
+            while not msgs:
+                if not self._fill_buffer():
+                    # need more data, don't spin waiting for it
+                    msgs.append(GameMessageEagain())
+                    break
+                self._parse_frames(msgs)
         except GameCommException as e:
             if e.is_0_bytes_read():
-                msg = GameMessageClosed()
-            elif e.is_bad_command():
-                msg = GameMessageBadCommand()
+                msgs.append(GameMessageClosed())
+            elif e.is_bad_command() or e.is_frame_too_large():
+                self.logger.error("read_mesgs: %s", e)
+                msgs.append(GameMessageBadCommand())
             else:
                 self.logger.error("Unexpected GameCommException: %s", e)
                 raise e
         except socket.error as e:
             if e.errno == errno.EAGAIN or e.errno == WINDOWS_EAGAIN:
-                self.logger.info("read_mesg: %s", e.strerror)
-                msg = GameMessageEagain()
+                self.logger.info("read_mesgs: %s", e.strerror)
+                msgs.append(GameMessageEagain())
             else:
                 self.logger.error("Unexpected socket.error: %s", e)
                 raise e
                 
-        return msg
+        return msgs
+
+    def read_mesg(self):
+        """Reads one GameMessage object from the socket.
+           Returns the object.
+           Messages that arrived in the same recv() are kept for the next call.
+           On error, returns
+             M_EAGAIN if a non-blocking socket has no complete message yet
+             M_NONE if the GameComm has previously failed
+             M_CLOSED if a 0 read occurs
+             M_BAD_COMMAND if an unknown message type or malformed body is received
+        """
+        if not self.pending:
+            self.pending.extend(self.read_mesgs())
+        return self.pending.popleft()
 
-    def _write_mesg(self, code, size, text):
-        string = "%s %d %s" % (code, size, text)
-        self.sock.sendall(string)
+    def _encode_frame(self, msg):
+        """returns the "CODE SIZE BODY" frame for msg, in the encoding agreed for this connection"""
+        code = msg.get_command()
+        if code in self.codecs:
+            try:
+                string = self.codecs[code].encode(msg)
+            except (struct.error, KeyError) as e:
+                # only this message is lost, the stream is untouched
+                raise GameCommException(E_BAD_CMD + ": cannot encode %s: %s" % (code, e))
+        elif code == M_SNAPSHOT:
+            string = "".join([ self._encode_frame(m) for m in msg.get_messages() ])
+        elif self.binary_out and code in self.message_codecs:
+            try:
+                string = self.message_codecs[code].encode(msg)
+            except (struct.error, KeyError) as e:
+                # only this message is lost, the stream is untouched
+                raise GameCommException(E_BAD_CMD + ": cannot encode %s: %s" % (code, e))
+        elif code in ALL_MESSAGE_CODES:
+            # known command
+            string = msg.to_string()
+        else:
+            self.ok = False
+            raise GameCommException(E_BAD_CMD)
+        return self._frame_header(code, len(string)) + string
+
+    def _frame_header(self, code, size):
+        if self.compact_out:
+            if not code in MESSAGE_ID_BYTES:
+                # a registered type needs an id in MESSAGE_CODES too
+                self.logger.error('_frame_header: %s has no compact id', code)
+                self.ok = False
+                raise GameCommException(E_BAD_CMD + ": no compact id for " + code)
+            return encode_compact_header(code, size)
+        return "%s %d " % (code, size)
+
+    def _channel_frame(self, channel):
+        """returns the M_CHANNEL frame that switches the peer over to channel"""
+        if channel != 0 and not C_CHANNELS in self.capabilities:
+            self.ok = False
+            raise GameCommException(E_BAD_CMD + ": channels not agreed")
+        self.channel_out = channel
+        string = str(channel)
+        return self._frame_header(M_CHANNEL, len(string)) + string
+
+    def _write_frames(self, frames):
+        """sends frames together, compressed and flushed as one block"""
+        data = "".join(frames)
+        if not data:
+            return
+        self.last_write = time.time()
+        self.bytes_out += len(data)
+        if self.compressor is not None:
+            data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.wire_bytes_out += len(data)
+        self._send_or_queue(data)
+        return
+
+    def _send_or_queue(self, data):
+        """sends socket bytes, queueing what the socket does not take"""
+        if self.outgoing:
+            # keep the order, behind the tail of an earlier write
+            self.outgoing += data
+            self.flush()
+            return
+        n = self._send(data)
+        if n < len(data):
+            self.outgoing += data[n:]
         return
+
+    def _send(self, data):
+        """one send(), returns the number of bytes taken, 0 if the socket is full"""
+        try:
+            return self.sock.send(data)
+        except socket.error as e:
+            if e.errno == errno.EAGAIN or e.errno == WINDOWS_EAGAIN:
+                return 0
+            raise e
+
+    def has_pending_output(self):
+        return len(self.outgoing) > 0
+
+    def get_pending_output_size(self):
+        """bytes written that the socket has not taken yet"""
+        return len(self.outgoing)
+
+    def frame_size(self, msg):
+        """Bytes msg takes in a write, before compression.
+           A binary body's size is known without encoding it, other
+           frames are encoded once: the next write_mesgs() reuses them."""
+        code = msg.get_command()
+        if code in self.codecs:
+            size = self.codecs[code].get_size(msg)
+        elif self.binary_out and code in self.message_codecs:
+            size = self.message_codecs[code].get_size()
+        else:
+            # the next write_mesgs() takes the frame from here
+            frame = self._encode_frame(msg)
+            self.sized_frames[id(msg)] = (msg, frame)
+            return len(frame)
+        return len(self._frame_header(code, size)) + size
+
+    def flush(self):
+        """Sends as much as the socket takes of what earlier writes left unsent.
+           Never blocks on a non-blocking socket.
+           Returns True once nothing is left."""
+        while self.outgoing:
+            n = self._send(buffer(self.outgoing))
+            if n == 0:
+                self.logger.debug('flush: %d bytes waiting', len(self.outgoing))
+                return False
+            del self.outgoing[:n]
+        return True
         
-    def write_mesg(self, msg):
+    def write_mesgs(self, msgs):
+        """Writes a batch of GameMessage objects with one send(),
+           and one compression flush.  Whatever the socket does not
+           take stays queued, ahead of the next write, see flush().
+           Each message goes out on its own channel, see M_CHANNEL.
+           Returns False if the GameComm has failed, or a message has an unknown type.
+           A message of a known type that cannot be encoded is left out,
+           and False returned once the others are written."""
+        code = None
+        skipped = False
         try:
             if not self.ok:
-                self.logger.error('write_mesg: self.ok = False')
+                self.logger.error('write_mesgs: self.ok = False')
                 return False
             
-            self.logger.info('write_mesg: msg: %s', msg)
-            code = msg.get_command()
-            
-            if code in ALL_MESSAGE_CODES:
-                # known command
-                string = msg.to_string()
-                size = len(string)
-                self._write_mesg(code, size, string)
-            else:
-                self.ok = False
-                raise GameCommException(E_BAD_CMD)
+            frames = []
+            for msg in msgs:
+                self.logger.info('write_mesg: msg: %s', msg)
+                code = msg.get_command()
+                enable = None
+                if code == M_LOGIN:
+                    enable = self._negotiate_write(msg)
+                sized = self.sized_frames.get(id(msg))
+                if sized is not None and sized[0] is msg:
+                    frame = sized[1]
+                else:
+                    try:
+                        frame = self._encode_frame(msg)
+                    except GameCommException as e:
+                        if not self.ok or not e.is_bad_command():
+                            raise
+                        self.logger.error('write_mesg: dropping %s: %s', code, e)
+                        skipped = True
+                        continue
+                # the body is encoded before the peer is switched to its channel
+                if msg.get_channel() != self.channel_out:
+                    frames.append(self._channel_frame(msg.get_channel()))
+                frames.append(frame)
+                if enable is not None:
+                    # the rest of the batch uses the agreed encoding
+                    self._write_frames(frames)
+                    frames = []
+                    self.enable_capabilities(enable)
+                    self.sized_frames = {}
+            self.sized_frames = {}
+            self._write_frames(frames)
 
         except GameCommException as e:
             if e.is_bad_command():
@@ -209,5 +929,7 @@ class GameComm:
                 self.logger.error('write_mesg: exception %s', e)
                 raise e
                 
-        return True
-        
+        return not skipped
+
+    def write_mesg(self, msg):
+        return self.write_mesgs([ msg ])
@@ -2,6 +2,7 @@
 # Don't change this file
 #
 import json
+from common.message_schema import schema_message, message_decoders
 
 ####################################################################        
 
@@ -21,6 +22,9 @@ M_REQUEST_VIEW      = "REQUEST_VIEW"
 M_WAIT_FOR_VIEW     = "WAIT_FOR_VIEW"
 M_GAME_STARTING   = "GAME_STARTING"
 M_GAME_OVER       = "GAME_OVER"
+M_HAVE_MAP        = "HAVE_MAP"
+M_HEARTBEAT       = "HEARTBEAT"
+M_CLOSE_CHANNEL   = "CLOSE_CHANNEL"
 M_CLOSED         = "CLOSED"
 M_BAD_COMMAND    = "BAD_COMMAND"
 M_EAGAIN         = "EAGAIN"
@@ -32,6 +36,7 @@ class GameMessage:
     def __init__(self, command=M_NONE):
         self.command = command
         self.data = {}
+        self.channel = 0 # match of a connection carrying several, not part of the body
         return
 
     def get_command(self):
@@ -41,6 +46,13 @@ class GameMessage:
         self.command = command
         return
 
+    def set_channel(self, channel):
+        self.channel = channel
+        return
+
+    def get_channel(self):
+        return self.channel
+
     def set_data(self, key, value):
         self.data[key] = value
         return
@@ -66,212 +78,114 @@ class GameMessage:
     def __repr__(self):
         return str(self)
 
+@schema_message(M_ECHO, [ ('text', 'str', '') ])
 class GameMessageEcho(GameMessage):
+    pass
 
-    def __init__(self):
-        GameMessage.__init__(self, M_ECHO)
-        self.set_text('')
-        return
-        
-    def set_text(self, text):
-        self.set_data('text', text)
-        return
-        
-    def get_text(self):
-        return self.get_data('text')
-        
-def string_to_echo_message(string):
-    msg = GameMessageEcho()
-    msg.from_string(string)
-    return msg
-
+@schema_message(M_BROADCAST, [ ('text', 'str', '') ])
 class GameMessageBroadcast(GameMessage):
+    pass
 
-    def __init__(self):
-        GameMessage.__init__(self, M_BROADCAST)
-        self.set_text('')
-        return
-        
-    def set_text(self, text):
-        self.set_data('text', text)
-        return
-        
-    def get_text(self):
-        return self.get_data('text')
-        
-def string_to_broadcast_message(string):
-    msg = GameMessageBroadcast()
-    msg.from_string(string)
-    return msg
-
+@schema_message(M_LOGIN, [ ('user',         'str',  ''),     # user
+                           ('request',      'bool', False),  # True if client->server request, False if server->client response
+                           ('result',       'bool', False),  # If is response, True  if login successful, False otherwise
+                           ('capabilities', 'list', []),     # request: optional features offered, response: features accepted
+                           ('mode_request', 'str',  None) ]) # request: code of the mode request to act on after login, or None
 class GameMessageLogin(GameMessage):
 
-    def __init__(self):
-        GameMessage.__init__(self, M_LOGIN)
-        self.set_user('')          # user
-        self.set_request(False)    # True if client->server request, False if server->client response
-        self.set_result(False)     # If is response, True  if login successful, False otherwise
-        return
-        
-    def set_user(self, user):
-        self.set_data('user', user)
-        return
-        
-    def get_user(self):
-        return self.get_data('user')
-        
-    def set_request(self, value):
-        self.set_data('request', value)
-        return
-        
-    def get_request(self):
-        return self.get_data('request')
-        
-    def set_result(self, value):
-        self.set_data('result', value)
-        return
-        
-    def get_result(self):
-        return self.get_data('result')
+    def get_capabilities(self):
+        """Returns a list, empty if the peer predates capabilities."""
+        capabilities = self.get_data('capabilities')
+        if capabilities is None:
+            return []
+        return capabilities
 
-def string_to_login_message(string):
-    msg = GameMessageLogin()
-    msg.from_string(string)
-    return msg
+    def get_mode_request(self):
+        """
+        Returns the code of the mode request (M_REQUEST_DUAL, ...) the
+        server should handle as soon as the login succeeds, or None.
+        A server that does so accepts PIPELINED_LOGIN in its response,
+        and the client then sends no separate mode request.
+        """
+        return self.get_data('mode_request')
 
 
+@schema_message(M_REQUEST_DUAL)
 class RequestDualMessage(GameMessage):
-    def __init__(self):
-        GameMessage.__init__(self, M_REQUEST_DUAL)
-        return
-        
-def string_to_request_dual_message(string):
-    msg = RequestDualMessage()
-    msg.from_string(string)
-    return msg
-    
+    pass
+
+@schema_message(M_WAIT_FOR_DUAL)
 class WaitForDualMessage(GameMessage):
-    def __init__(self):
-        GameMessage.__init__(self, M_WAIT_FOR_DUAL)
-        return
-        
-def string_to_wait_for_dual_message(string):
-    msg = WaitForDualMessage()
-    msg.from_string(string)
-    return msg
-    
+    pass
+
+@schema_message(M_REQUEST_SINGLE)
 class RequestSingleMessage(GameMessage):
-    def __init__(self):
-        GameMessage.__init__(self, M_REQUEST_SINGLE)
-        return
-        
-def string_to_request_single_message(string):
-    msg = RequestSingleMessage()
-    msg.from_string(string)
-    return msg
+    pass
 
+@schema_message(M_WAIT_FOR_SINGLE)
 class WaitForSingleMessage(GameMessage):
-    def __init__(self):
-        GameMessage.__init__(self, M_WAIT_FOR_SINGLE)
-        return
-        
-def string_to_wait_for_single_message(string):
-    msg = WaitForSingleMessage()
-    msg.from_string(string)
-    return msg
-    
+    pass
+
+@schema_message(M_REQUEST_TOURNAMENT)
 class RequestTournamentMessage(GameMessage):
-    def __init__(self):
-        GameMessage.__init__(self, M_REQUEST_TOURNAMENT)
-        return
-        
-def string_to_request_tournament_message(string):
-    msg = RequestTournamentMessage()
-    msg.from_string(string)
-    return msg
+    pass
 
+@schema_message(M_WAIT_FOR_TOURNAMENT)
 class WaitForTournamentMessage(GameMessage):
-    def __init__(self):
-        GameMessage.__init__(self, M_WAIT_FOR_TOURNAMENT)
-        return
-        
-def string_to_wait_for_tournament_message(string):
-    msg = WaitForTournamentMessage()
-    msg.from_string(string)
-    return msg
-    
+    pass
+
+@schema_message(M_REQUEST_AI)
 class RequestAiMessage(GameMessage):
-    def __init__(self):
-        GameMessage.__init__(self, M_REQUEST_AI)
-        return
-        
-def string_to_request_ai_message(string):
-    msg = RequestAiMessage()
-    msg.from_string(string)
-    return msg
+    pass
 
+@schema_message(M_WAIT_FOR_AI)
 class WaitForAiMessage(GameMessage):
-    def __init__(self):
-        GameMessage.__init__(self, M_WAIT_FOR_AI)
-        return
-        
-def string_to_wait_for_ai_message(string):
-    msg = WaitForAiMessage()
-    msg.from_string(string)
-    return msg
-    
+    pass
+
+@schema_message(M_REQUEST_VIEW)
 class RequestViewMessage(GameMessage):
-    def __init__(self):
-        GameMessage.__init__(self, M_REQUEST_VIEW)
-        return
-        
-def string_to_request_view_message(string):
-    msg = RequestViewMessage()
-    msg.from_string(string)
-    return msg
+    pass
 
+@schema_message(M_WAIT_FOR_VIEW)
 class WaitForViewMessage(GameMessage):
-    def __init__(self):
-        GameMessage.__init__(self, M_WAIT_FOR_VIEW)
-        return
-        
-def string_to_wait_for_view_message(string):
-    msg = WaitForViewMessage()
-    msg.from_string(string)
-    return msg
-    
+    pass
+
+# player_oid: the receiving client's player oid, -1 if the server leaves it to REQUEST_PLAYER_OID
+# map_hash: hash of the game's walls, see common.wall.walls_hash(),
+#           None if the server sends them without waiting for HAVE_MAP
+@schema_message(M_GAME_STARTING, [ ('opponent_name', 'str', ""),
+                                   ('player_oid',    'int', -1),
+                                   ('map_hash',      'str', None) ])
 class GameStartingMessage(GameMessage):
-    def __init__(self, oname=""):
-        GameMessage.__init__(self, M_GAME_STARTING)
-        self.set_opponent_name(oname)
-        return
-    def set_opponent_name(self, oname):
-        self.set_data('opponent_name', oname)
-        return
-    def get_opponent_name(self):
-        return self.get_data('opponent_name')
-        
-def string_to_game_starting_message(string):
-    msg = GameStartingMessage()
-    msg.from_string(string)
-    return msg
-    
-    
+    pass
+
+@schema_message(M_GAME_OVER, [ ('winner_name', 'str', "") ])
 class GameOverMessage(GameMessage):
-    def __init__(self, wname=""):
-        GameMessage.__init__(self, M_GAME_OVER)
-        self.set_winner_name(wname)
-        return
-    def set_winner_name(self, wname=""):
-        self.set_data('winner_name', wname)
-        return
-    def get_winner_name(self):
-        return self.get_data('winner_name')
-        
-def string_to_game_over_message(string):
-    msg = GameOverMessage()
-    msg.from_string(string)
-    return msg
+    pass
+
+@schema_message(M_HAVE_MAP, [ ('map_hash', 'str',  None),
+                              ('have',     'bool', False) ])
+class HaveMapMessage(GameMessage):
+    """
+    The client's answer to a GAME_STARTING with a map hash:
+    if it has those walls cached, the server does not send them.
+    """
+
+@schema_message(M_HEARTBEAT)
+class HeartbeatMessage(GameMessage):
+    """
+    Written by either end when it has written nothing else for a
+    while, so that the peer can tell a quiet connection from a dead
+    one.  GameComm reads it without returning it.
+    """
+
+@schema_message(M_CLOSE_CHANNEL)
+class CloseChannelMessage(GameMessage):
+    """
+    Sent by the client on a channel it no longer wants, with CHANNELS:
+    the server leaves that match, sends nothing more on the channel,
+    and drops what it keeps for it.  Channel 0 closes with the connection.
+    """
     
     
 class GameMessageClosed(GameMessage):
@@ -289,19 +203,71 @@ class GameMessageEagain(GameMessage):
         GameMessage.__init__(self, M_EAGAIN)
         return
 
-GAME_MESSAGES = { M_ECHO:            string_to_echo_message,
-                  M_BROADCAST:       string_to_broadcast_message,
-                  M_LOGIN:           string_to_login_message,
-                  M_REQUEST_DUAL:    string_to_request_dual_message,
-                  M_WAIT_FOR_DUAL:   string_to_wait_for_dual_message,
-                  M_REQUEST_SINGLE:  string_to_request_single_message, 
-                  M_WAIT_FOR_SINGLE: string_to_wait_for_single_message, 
-                  M_REQUEST_TOURNAMENT:  string_to_request_tournament_message, 
-                  M_WAIT_FOR_TOURNAMENT: string_to_wait_for_tournament_message, 
-                  M_REQUEST_AI:      string_to_request_ai_message, 
-                  M_WAIT_FOR_AI:     string_to_wait_for_ai_message, 
-                  M_REQUEST_VIEW:    string_to_request_view_message, 
-                  M_WAIT_FOR_VIEW:   string_to_wait_for_view_message, 
-                  M_GAME_STARTING:   string_to_game_starting_message,
-                  M_GAME_OVER:       string_to_game_over_message, }
+GAME_MESSAGES = message_decoders([ GameMessageEcho, GameMessageBroadcast, GameMessageLogin,
+                                   RequestDualMessage, WaitForDualMessage,
+                                   RequestSingleMessage, WaitForSingleMessage,
+                                   RequestTournamentMessage, WaitForTournamentMessage,
+                                   RequestAiMessage, WaitForAiMessage,
+                                   RequestViewMessage, WaitForViewMessage,
+                                   GameStartingMessage, GameOverMessage, HaveMapMessage,
+                                   HeartbeatMessage, CloseChannelMessage ])
+
+
+#
+# Handlers for messages arriving at the client, keyed by command code.
+# ClientGameEngine.process_server_message() calls handler(engine, msg)
+# for each message.  Each message module registers the handlers for
+# its own messages; extensions can register more, or replace these.
+#
+CLIENT_HANDLERS = {}
+
+def register_client_handler(code, handler):
+    CLIENT_HANDLERS[code] = handler
+    return
+
+def get_client_handler(code):
+    if not code in CLIENT_HANDLERS:
+        return None
+    return CLIENT_HANDLERS[code]
+
+def handle_login(engine, msg):
+    if (not msg.get_request()) and msg.get_result():
+        engine.logged_in(msg)
+    return
+
+def handle_wait_for_dual(engine, msg):
+    engine.get_data().set_waiting_for_dual()
+    return
+
+def handle_wait_for_single(engine, msg):
+    engine.get_data().set_waiting_for_single()
+    return
+
+def handle_wait_for_tournament(engine, msg):
+    engine.get_data().set_waiting_for_tournament()
+    return
+
+def handle_wait_for_ai(engine, msg):
+    engine.get_data().set_waiting_for_ai()
+    return
+
+def handle_wait_for_view(engine, msg):
+    engine.get_data().set_waiting_for_view()
+    return
+
+def handle_game_starting(engine, msg):
+    engine.game_starting(msg)
+    return
+
+def handle_game_over(engine, msg):
+    engine.game_over(msg)
+    return
 
+register_client_handler(M_LOGIN,               handle_login)
+register_client_handler(M_WAIT_FOR_DUAL,       handle_wait_for_dual)
+register_client_handler(M_WAIT_FOR_SINGLE,     handle_wait_for_single)
+register_client_handler(M_WAIT_FOR_TOURNAMENT, handle_wait_for_tournament)
+register_client_handler(M_WAIT_FOR_AI,         handle_wait_for_ai)
+register_client_handler(M_WAIT_FOR_VIEW,       handle_wait_for_view)
+register_client_handler(M_GAME_STARTING,       handle_game_starting)
+register_client_handler(M_GAME_OVER,           handle_game_over)
@@ -0,0 +1,176 @@
+#
+# Declarative definitions of the message types.
+#
+# Each message type is a code and a list of (key, type, default)
+# fields.  @schema_message generates the message class from them,
+# and the MessageSchema decodes its JSON bodies and, when every
+# field has a fixed size, packs and unpacks a binary body.
+#
+import json, struct, copy
+
+# field types: (struct format, converter from a JSON value).
+# a format of None is JSON only, the type has no fixed size.
+# a tuple of strings as the type is an enumeration: one byte, the
+# index of the value, so values are only ever appended to it.
+FIELD_TYPES = { 'int':    ('i', int),
+                'byte':   ('B', int),
+                'bool':   ('?', bool),
+                'float':  ('f', float),
+                'double': ('d', float),
+                'str':    (None, None),
+                'list':   (None, list),
+                'dict':   (None, dict) }
+
+# MessageSchema of each message code, see build_message_codecs()
+SCHEMAS = {}
+
+def field_format(kind):
+    """returns the struct format of a field type, None if it has no fixed size"""
+    if isinstance(kind, tuple):
+        return 'B'
+    return FIELD_TYPES[kind][0]
+
+class MessageSchema:
+    """
+    The fields of one message type, and the tuples precomputed
+    from them for its codecs.  The binary body is the fields in
+    order, little endian, as ObjectCodec packs object updates.
+    Creating a schema registers it in SCHEMAS.
+    """
+
+    def __init__(self, code, fields):
+        self.code = code
+        self.fields = tuple(fields)
+        self.keys = tuple([ key for (key, kind, default) in fields ])
+        self.defaults = dict([ (key, default) for (key, kind, default) in fields ])
+        self.items = tuple([ (key, default) for (key, kind, default) in fields ])
+        # fields whose default is copied into each message
+        self.mutables = tuple([ key for (key, kind, default) in fields if kind in ('list', 'dict') ])
+        # (position, values, value -> index) of each enumeration
+        self.enums = tuple([ (i, kind, dict(zip(kind, range(len(kind)))))
+                             for (i, (key, kind, default)) in enumerate(fields)
+                             if isinstance(kind, tuple) ])
+        formats = [ field_format(kind) for (key, kind, default) in fields ]
+        if None in formats:
+            self.struct = None
+        else:
+            self.struct = struct.Struct('<' + "".join(formats))
+        self.message_class = None  # set by @schema_message
+        SCHEMAS[code] = self
+        return
+
+    def get_code(self):
+        return self.code
+
+    def get_keys(self):
+        return self.keys
+
+    def is_fixed(self):
+        """True if the messages have a binary body"""
+        return self.struct is not None
+
+    def get_size(self):
+        return self.struct.size
+
+    def set_fields(self, msg, values=(), fields=None):
+        """Fills in the data of a new msg: the defaults, then
+           values in field order, then the fields dictionary."""
+        if len(values) > len(self.keys):
+            raise TypeError("%s takes at most %d fields" % (self.code, len(self.keys)))
+        data = msg.data
+        data.update(self.defaults)
+        for key in self.mutables:
+            data[key] = copy.copy(data[key])
+        data.update(zip(self.keys, values))
+        if fields:
+            for key in fields:
+                if not key in self.defaults:
+                    raise TypeError("%s has no field %s" % (self.code, key))
+            data.update(fields)
+        return
+
+    def decode_json(self, string):
+        """returns the message of a JSON body"""
+        msg = self.message_class()
+        msg.data = json.loads(string)['data']
+        return msg
+
+    def encode(self, msg):
+        """returns the binary body of msg, missing or None fields take their default"""
+        data = msg.data
+        values = []
+        for (key, default) in self.items:
+            value = data.get(key)
+            if value is None:
+                value = default
+            values.append(value)
+        for (i, kind, index) in self.enums:
+            values[i] = index[values[i]]
+        return self.struct.pack(*values)
+
+    def decode(self, body):
+        """body may be a str or a memoryview of a frame"""
+        values = self.struct.unpack_from(body)
+        if self.enums:
+            values = list(values)
+            for (i, kind, index) in self.enums:
+                values[i] = kind[values[i]]
+        msg = self.message_class()
+        msg.data = dict(zip(self.keys, values))
+        return msg
+
+def _make_init(base, schema):
+    def __init__(self, *values, **fields):
+        base.__init__(self, schema.code)
+        schema.set_fields(self, values, fields)
+        return
+    return __init__
+
+def _make_getter(key, default):
+    def getter(self):
+        return self.data.get(key, default)
+    getter.__name__ = 'get_' + key
+    return getter
+
+def _make_setter(key):
+    def setter(self, value):
+        self.data[key] = value
+        return
+    setter.__name__ = 'set_' + key
+    return setter
+
+def schema_message(code, fields=()):
+    """
+    Class decorator for a GameMessage subclass: makes it the class
+    of the messages of code, with fields a list of (key, type, default).
+    Adds an __init__ taking the fields in order, or by key, and
+    get_<key>() and set_<key>() for each field, unless the class
+    defines them itself.  A getter returns the field's default if
+    the message lacks it, None for a list or dict.
+    """
+    def decorate(cls):
+        schema = MessageSchema(code, fields)
+        schema.message_class = cls
+        cls.schema = schema
+        methods = cls.__dict__
+        if not '__init__' in methods:
+            cls.__init__ = _make_init(cls.__bases__[0], schema)
+        for (key, kind, default) in schema.fields:
+            if key in schema.mutables:
+                default = None
+            if not 'get_' + key in methods:
+                setattr(cls, 'get_' + key, _make_getter(key, default))
+            if not 'set_' + key in methods:
+                setattr(cls, 'set_' + key, _make_setter(key))
+        return cls
+    return decorate
+
+def message_decoders(classes):
+    """returns the JSON decoder of each class's messages, keyed by message code"""
+    return dict([ (cls.schema.code, cls.schema.decode_json) for cls in classes ])
+
+def build_message_codecs(exclude=()):
+    """returns the MessageSchema of every message type with a binary body,
+       keyed by code, but for the codes in exclude"""
+    return dict([ (code, SCHEMAS[code]) for code in SCHEMAS
+                  if SCHEMAS[code].is_fixed() and not code in exclude ])
@@ -7,6 +7,7 @@
 # get_power() how much damage it will cause
 # get_player_oid() which player launched it
 # get_hit_max_range() true if it traveled maximum range
+# advance(seconds) move it as the server would, for clients that only get spawn updates
 
 from object import ObjectData
 class MissileData(ObjectData):
@@ -43,6 +44,7 @@ class MissileData(ObjectData):
 
     def set_range(self, range):
         self.range = float(range)
+        self.changed = True
         return
         
     def get_power(self):
@@ -50,6 +52,7 @@ class MissileData(ObjectData):
 
     def set_power(self, power):
         self.power = float(power)
+        self.changed = True
         return
         
     def get_player_oid(self):
@@ -57,6 +60,7 @@ class MissileData(ObjectData):
 
     def set_player_oid(self, player_oid):
         self.player_oid = player_oid
+        self.changed = True
         return
         
     def get_hit_max_range(self):
@@ -64,6 +68,21 @@ class MissileData(ObjectData):
 
     def set_hit_max_range(self, hit_max_range):
         self.hit_max_range = hit_max_range
+        self.changed = True
+        return
+
+    def advance(self, seconds):
+        """
+        Moves the missile the way it flies between updates: in a
+        straight line at its speed along (dx, dy), stopping at its range.
+        """
+        step = min(self.speed * seconds, self.range - self.distance)
+        if step <= 0.:
+            return
+        self.x += step * self.dx
+        self.y += step * self.dy
+        self.distance += step
+        self.changed = True
         return
 
     def is_missile(self):
@@ -26,7 +26,10 @@
 # get_pw() width, rounded to nearest integer
 # get_ph() height, rounded to nearest integer
 # get_pdistance() distance traveled, rounded to nearest integer
+# get_tick() server tick of the last update received, -1 if unknown
+# get_tick_time() server time of that tick, in seconds
 
+import struct
 
 STATE_ALIVE = 1
 STATE_DYING = 2
@@ -34,6 +37,28 @@ STATE_DEAD  = 3
 
 INFINITE_HEALTH = 1000000
 
+# seconds an object spends dying, dying_percent goes from 0 to 1 over it
+DYING_TIME = 3.0
+
+# coordinates travel as float32, or as 16 bit integers in
+# 1/COORD_SCALE pixels, see common.object_codec
+COORD_SCALE = 16.
+_FLOAT32 = struct.Struct('<f')
+
+def quantize(value):
+    """value in whole 1/COORD_SCALE pixels, taken from its float32:
+       the same whichever encoding carried it"""
+    return int(round(_FLOAT32.unpack(_FLOAT32.pack(value))[0] * COORD_SCALE))
+
+class _DataCollector:
+    """Stands in for a GameMessage, to gather the fields set by set_message()."""
+    def __init__(self):
+        self.data = {}
+        return
+    def set_data(self, key, value):
+        self.data[key] = value
+        return
+
 class ObjectData:
     """
     All data associated with generic game objects.
@@ -58,6 +83,8 @@ class ObjectData:
         self.health  = INFINITE_HEALTH # health of object.  <= 0 is dead
         self.max_health = INFINITE_HEALTH # maximum health of object
         self.dying_percent = 0.0 # number 0.0 -> 1.0, percentage of time from 0 health to dead  only relevant if state == STATE_DYING
+        self.tick = -1       # client only: server tick of the last update applied
+        self.tick_time = 0.0 # client only: server time of that tick
         return
 
     def set_message(self, msg):
@@ -91,6 +118,27 @@ class ObjectData:
         self.set_max_health(msg.get_data('max_health'))
         self.set_dying_percent(msg.get_data('dying_percent'))
         return
+
+    def get_message_data(self):
+        """Returns the fields of an update message for this object, as a dictionary."""
+        collector = _DataCollector()
+        self.set_message(collector)
+        return collector.data
+
+    def apply_delta(self, fields):
+        """Updates only the fields present in the dictionary, as sent by an ObjectDeltaMessage."""
+        for key in fields:
+            getattr(self, 'set_' + key)(fields[key])
+        return
+
+    def get_changed(self):
+        return self.changed
+
+    def set_changed(self, changed):
+        """The server clears this once the object has been sent to every client.
+           Setters mark it again."""
+        self.changed = changed
+        return
         
     def get_oid(self):
         return self.oid
@@ -148,46 +196,57 @@ class ObjectData:
         
     def set_oid(self, oid):
         self.oid = int(oid)
+        self.changed = True
         return
         
     def set_x(self, x):
         self.x = float(x)
+        self.changed = True
         return
         
     def set_y(self, y):
         self.y = float(y)
+        self.changed = True
         return
         
     def set_w(self, w):
         self.w = float(w)
+        self.changed = True
         return
         
     def set_h(self, h):
         self.h = float(h)
+        self.changed = True
         return
         
     def set_dx(self, dx):
         self.dx = float(dx)
+        self.changed = True
         return
         
     def set_dy(self, dy):
         self.dy = float(dy)
+        self.changed = True
         return
         
     def set_distance(self, distance):
         self.distance = float(distance)
+        self.changed = True
         return
         
     def add_distance(self, new_distance):
         self.distance += new_distance
+        self.changed = True
         return
         
     def set_speed(self, speed):
         self.speed = float(speed)
+        self.changed = True
         return
         
     def set_state(self, state):
         self.state = state
+        self.changed = True
         return
     def set_alive(self):
         self.set_state(STATE_ALIVE)
@@ -207,14 +266,29 @@ class ObjectData:
 
     def set_health(self, health):
         self.health = float(health)
+        self.changed = True
         return
         
     def set_max_health(self, max_health):
         self.max_health = float(max_health)
+        self.changed = True
         return
         
     def set_dying_percent(self, dying_percent):
         self.dying_percent = float(dying_percent)
+        self.changed = True
+        return
+        
+    def get_tick(self):
+        return self.tick
+
+    def get_tick_time(self):
+        return self.tick_time
+
+    def set_tick(self, tick, tick_time):
+        """Versions the object on the client; not sent, so it does not mark it changed."""
+        self.tick = tick
+        self.tick_time = tick_time
         return
         
     def __str__(self):
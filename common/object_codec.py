@@ -0,0 +1,171 @@
+#
+# Binary encoding of the object update messages.
+#
+# Used by GameComm in place of JSON once both ends have agreed
+# to it at LOGIN.  Each message type has a fixed struct layout,
+# in the order of the fields below.
+#
+import struct
+from common.object_message import *
+from common.message_schema import FIELD_TYPES, field_format
+from common.object import COORD_SCALE, quantize
+
+# fields packed as 16 bit integers, in 1/COORD_SCALE pixels, when quantized
+QUANTIZED_KEYS = ('x', 'y', 'w', 'h')
+QUANTIZED_FORMAT = 'h'
+
+class ObjectCodec:
+    """
+    Packs and unpacks one object update message type with the
+    struct layout of its schema, see common.object_message.
+    The decode_object methods fill in an ObjectData directly,
+    skipping the message's data dictionary and the per-field setters.
+    """
+
+    def __init__(self, message_class, object_class, quantized=False):
+        schema = message_class.schema
+        self.code = schema.get_code()
+        self.message_class = message_class
+        self.object_class = object_class
+        self.keys = schema.get_keys()
+        # how a JSON value is converted for each field, as the setters would
+        self.converters = tuple([ (key, FIELD_TYPES[kind][1]) for (key, kind, default) in schema.fields ])
+        fmt = '<'
+        scaled = []
+        for (key, kind, default) in schema.fields:
+            if quantized and key in QUANTIZED_KEYS:
+                fmt += QUANTIZED_FORMAT
+                scaled.append(key)
+            else:
+                fmt += field_format(kind)
+        self.struct = struct.Struct(fmt)
+        self.scaled = tuple(scaled)
+        return
+
+    def get_size(self, msg=None):
+        """bytes in the body of every message of this type"""
+        return self.struct.size
+
+    def encode(self, msg):
+        data = msg.data
+        if self.scaled:
+            data = dict(data)
+            for key in self.scaled:
+                data[key] = quantize(data[key])
+        return self.struct.pack(*[ data[key] for key in self.keys ])
+
+    def decode(self, body):
+        """body may be a str or a memoryview of a frame"""
+        msg = self.message_class()
+        msg.data = dict(zip(self.keys, self.struct.unpack_from(body)))
+        for key in self.scaled:
+            msg.data[key] /= COORD_SCALE
+        return msg
+
+    def _target(self, oid, lookup, tick):
+        """the object to decode into: the one lookup(oid) has, or a new one
+           if there is none, or it is newer than this update of tick.
+           It is stamped with tick, so that the engine does not advance
+           it again for a TICK that comes before it in the same batch."""
+        obj = lookup(oid)
+        if obj is None or obj.__class__ is not self.object_class or obj.tick > tick:
+            obj = self.object_class()
+        obj.tick = tick
+        return obj
+
+    def _object_message(self, obj):
+        msg = self.message_class()
+        msg.set_object(obj)
+        return msg
+
+    def decode_object(self, body, lookup, tick=-1):
+        """Unpacks a binary body straight into an object.
+           lookup(oid) returns the object to reuse, or None for a new one.
+           tick is the server tick of the update, if known.
+           Returns the update message, carrying the object."""
+        values = self.struct.unpack_from(body)
+        obj = self._target(values[0], lookup, tick)
+        fields = obj.__dict__
+        fields.update(zip(self.keys, values))
+        for key in self.scaled:
+            fields[key] /= COORD_SCALE
+        return self._object_message(obj)
+
+    def decode_json_object(self, data, lookup, tick=-1):
+        """Same as decode_object(), for the data dictionary of a JSON body."""
+        obj = self._target(int(data['oid']), lookup, tick)
+        fields = obj.__dict__
+        for (key, convert) in self.converters:
+            fields[key] = convert(data[key])
+        return self._object_message(obj)
+
+# the fields an OBJECT_DELTA may carry, one bit each in its mask, in this order.
+# only ever append to it.
+DELTA_FIELDS = [ field for field in PLAYER_FIELDS + MISSILE_FIELDS[len(OBJECT_FIELDS):]
+                 if field[0] != 'oid' ]
+
+class DeltaCodec:
+    """
+    Packs and unpacks OBJECT_DELTA messages: the oid, a 32 bit mask
+    of the DELTA_FIELDS present, then the values of those fields, in
+    DELTA_FIELDS order, with the formats of their object updates.
+    Coordinates are never quantized in a delta.
+    """
+
+    def __init__(self):
+        self.header = struct.Struct('<iI')
+        self.bits = dict([ (DELTA_FIELDS[i][0], 1 << i) for i in range(len(DELTA_FIELDS)) ])
+        self.layouts = {}  # mask -> (struct of the values, keys in order)
+        return
+
+    def _layout(self, mask):
+        """the struct and keys of the values of mask, built once per mask"""
+        layout = self.layouts.get(mask)
+        if layout is None:
+            fields = [ DELTA_FIELDS[i] for i in range(len(DELTA_FIELDS)) if mask & (1 << i) ]
+            layout = (struct.Struct('<' + "".join([ field_format(kind) for (key, kind, default) in fields ])),
+                      tuple([ key for (key, kind, default) in fields ]))
+            self.layouts[mask] = layout
+        return layout
+
+    def _mask(self, fields):
+        """raises KeyError for a field that is not in DELTA_FIELDS"""
+        mask = 0
+        for key in fields:
+            mask |= self.bits[key]
+        return mask
+
+    def get_size(self, msg):
+        return self.header.size + self._layout(self._mask(msg.get_fields()))[0].size
+
+    def encode(self, msg):
+        fields = msg.get_fields()
+        mask = self._mask(fields)
+        values, keys = self._layout(mask)
+        return self.header.pack(msg.get_oid(), mask) + values.pack(*[ fields[key] for key in keys ])
+
+    def decode(self, body):
+        """body may be a str or a memoryview of a frame"""
+        oid, mask = self.header.unpack_from(body)
+        values, keys = self._layout(mask)
+        return ObjectDeltaMessage(oid, dict(zip(keys, values.unpack_from(body, self.header.size))))
+
+    def decode_object(self, body, lookup, tick=-1):
+        """a delta is applied by the engine, see handle_object_delta(),
+           which compares its tick with the object's"""
+        msg = self.decode(body)
+        msg.set_tick(tick)
+        return msg
+
+    def decode_json_object(self, data, lookup, tick=-1):
+        msg = ObjectDeltaMessage(data['oid'], data['fields'])
+        msg.set_tick(tick)
+        return msg
+
+def build_object_codecs(quantized=False):
+    """returns a dictionary of ObjectCodec, and the DeltaCodec, keyed by message code"""
+    return { M_PLAYER_UPDATE:  ObjectCodec(PlayerUpdateMessage,  PlayerData,  quantized),
+             M_WALL_UPDATE:    ObjectCodec(WallUpdateMessage,    WallData,    quantized),
+             M_NPC_UPDATE:     ObjectCodec(NPCUpdateMessage,     NPCData,     quantized),
+             M_MISSILE_UPDATE: ObjectCodec(MissileUpdateMessage, MissileData, quantized),
+             M_OBJECT_DELTA:   DeltaCodec() }
@@ -1,105 +1,315 @@
 #
 # Don't change this file
 #
-from common.game_message import GameMessage
+from common.game_message import GameMessage, register_client_handler
 from common.player  import PlayerData
 from common.wall  import WallData
 from common.npc  import NPCData
 from common.missile  import MissileData
+from common.object import STATE_DEAD
+from common.extrapolation import extrapolate, is_extrapolated
+from common.message_schema import schema_message, message_decoders
 
 M_PLAYER_UPDATE = "PLAYER_UPDATE"
 M_WALL_UPDATE   = "WALL_UPDATE"
 M_NPC_UPDATE    = "NPC_UPDATE"
 M_MISSILE_UPDATE    = "MISSILE_UPDATE"
+M_OBJECT_DELTA      = "OBJECT_DELTA"
 
-class PlayerUpdateMessage(GameMessage):
+# (key, type, default) of the fields of each object update, in
+# the order of their binary layout, see common.object_codec
+OBJECT_FIELDS = [ ('oid',           'int',   -1),
+                  ('x',             'float', 0.),
+                  ('y',             'float', 0.),
+                  ('w',             'float', 0.),
+                  ('h',             'float', 0.),
+                  ('dx',            'float', 0.),
+                  ('dy',            'float', 0.),
+                  ('distance',      'float', 0.),
+                  ('speed',         'float', 0.),
+                  ('state',         'byte',  0),
+                  ('health',        'float', 0.),
+                  ('max_health',    'float', 0.),
+                  ('dying_percent', 'float', 0.) ]
+
+PLAYER_FIELDS = OBJECT_FIELDS + [ ('experience',                 'float', 0.),
+                                  ('missile_range',              'float', 0.),
+                                  ('missile_dx',                 'float', 0.),
+                                  ('missile_dy',                 'float', 0.),
+                                  ('missile_power',              'float', 0.),
+                                  ('missile_mana',               'float', 0.),
+                                  ('missile_mana_recharge_rate', 'float', 0.),
+                                  ('missile_mana_max',           'float', 0.),
+                                  ('move_mana',                  'float', 0.),
+                                  ('move_mana_recharge_rate',    'float', 0.),
+                                  ('move_mana_max',              'float', 0.) ]
+
+MISSILE_FIELDS = OBJECT_FIELDS + [ ('range',         'float', 0.),
+                                   ('power',         'float', 0.),
+                                   ('player_oid',    'int',   -1),
+                                   ('hit_max_range', 'bool',  False) ]
+
+class ObjectUpdateMessage(GameMessage):
+    """
+    Base of the object update messages.  Normally the fields are
+    in the data dictionary.  GameComm's decode fast path skips the
+    dictionary, and hands over the finished object instead.
+    """
+    def __init__(self, command, obj=None):
+        GameMessage.__init__(self, command)
+        self.object = None
+        if obj:
+            obj.set_message(self)
+        return
+
+    def get_object(self):
+        """Returns the object decoded by the fast path, or None."""
+        return self.object
+
+    def set_object(self, obj):
+        self.object = obj
+        return
+
+    def __str__(self):
+        if self.object is not None:
+            return "%s(%s)" % (self.command, self.object)
+        return GameMessage.__str__(self)
+
+@schema_message(M_PLAYER_UPDATE, PLAYER_FIELDS)
+class PlayerUpdateMessage(ObjectUpdateMessage):
     def __init__(self, player=None):
-        GameMessage.__init__(self, M_PLAYER_UPDATE)
-        if player:
-            player.set_message(self)
+        ObjectUpdateMessage.__init__(self, M_PLAYER_UPDATE, player)
         return
 
     def get_player(self):
+        if self.object is not None:
+            return self.object
         player = PlayerData()
         player.set_from_message(self)
         return player
 
-def string_to_player_update_message(string):
-    msg = PlayerUpdateMessage()
-    msg.from_string(string)
-    return msg
-    
-class WallUpdateMessage(GameMessage):
+@schema_message(M_WALL_UPDATE, OBJECT_FIELDS)
+class WallUpdateMessage(ObjectUpdateMessage):
     def __init__(self, wall=None):
-        GameMessage.__init__(self, M_WALL_UPDATE)
-        if wall:
-            wall.set_message(self)
+        ObjectUpdateMessage.__init__(self, M_WALL_UPDATE, wall)
         return
 
     def get_wall(self):
+        if self.object is not None:
+            return self.object
         wall = WallData()
         wall.set_from_message(self)
         return wall
 
-def string_to_wall_update_message(string):
-    msg = WallUpdateMessage()
-    msg.from_string(string)
-    return msg
-
-class NPCUpdateMessage(GameMessage):
+@schema_message(M_NPC_UPDATE, OBJECT_FIELDS)
+class NPCUpdateMessage(ObjectUpdateMessage):
     def __init__(self, npc=None):
-        GameMessage.__init__(self, M_NPC_UPDATE)
-        if npc:
-            npc.set_message(self)
+        ObjectUpdateMessage.__init__(self, M_NPC_UPDATE, npc)
         return
 
     def get_npc(self):
+        if self.object is not None:
+            return self.object
         npc = NPCData()
         npc.set_from_message(self)
         return npc
 
-def string_to_npc_update_message(string):
-    msg = NPCUpdateMessage()
-    msg.from_string(string)
-    return msg
-
-class MissileUpdateMessage(GameMessage):
+@schema_message(M_MISSILE_UPDATE, MISSILE_FIELDS)
+class MissileUpdateMessage(ObjectUpdateMessage):
     def __init__(self, missile=None):
-        GameMessage.__init__(self, M_MISSILE_UPDATE)
-        if missile:
-            missile.set_message(self)
+        ObjectUpdateMessage.__init__(self, M_MISSILE_UPDATE, missile)
         return
 
     def get_missile(self):
+        if self.object is not None:
+            return self.object
         missile = MissileData()
         missile.set_from_message(self)
         return missile
 
-def string_to_missile_update_message(string):
-    msg = MissileUpdateMessage()
-    msg.from_string(string)
+@schema_message(M_OBJECT_DELTA, [ ('oid',    'int',  -1),
+                                  ('fields', 'dict', {}) ])
+class ObjectDeltaMessage(GameMessage):
+    """
+    Carries only the fields of an object that changed since
+    the last update sent to this client.  The client merges
+    them into the object it already has.
+    """
+    tick = -1  # server tick it was read under, if GameComm knows it
+
+    def get_tick(self):
+        return self.tick
+
+    def set_tick(self, tick):
+        self.tick = tick
+        return
+
+def object_to_message(obj):
+    """Returns the full update message for obj."""
+    if obj.is_player():
+        msg = PlayerUpdateMessage(obj)
+    elif obj.is_missile():
+        msg = MissileUpdateMessage(obj)
+    elif obj.is_npc():
+        msg = NPCUpdateMessage(obj)
+    elif obj.is_wall():
+        msg = WallUpdateMessage(obj)
+    else:
+        msg = None
     return msg
 
+class ObjectDeltaTracker:
+    """
+    Server side, one per client connection.  Remembers the
+    fields last sent for each object, so that only what has
+    changed since then is sent again.
+    With missile_spawns, a live missile is only sent when it
+    appears, the client moves it until it hits or runs out of range.
+    With extrapolate, the fields in common.extrapolation are
+    advanced as the client advances them, and only sent when the
+    client's value is off by more than EXTRAPOLATION_TOLERANCE.
+    """
+    def __init__(self, missile_spawns=False, extrapolate=False):
+        self.sent = {}   # oid -> dictionary of fields the client holds
+        self.sent_times = {} # oid -> server time those fields apply at, with extrapolate
+        self.unsent = {} # oid -> tick_time of an update made but not committed yet
+        self.missile_spawns = missile_spawns
+        self.extrapolate = extrapolate
+        return
+
+    def set_missile_spawns(self, missile_spawns):
+        self.missile_spawns = missile_spawns
+        return
+
+    def get_missile_spawns(self):
+        return self.missile_spawns
+
+    def set_extrapolate(self, extrapolate):
+        self.extrapolate = extrapolate
+        return
+
+    def get_extrapolate(self):
+        return self.extrapolate
+
+    def update_message(self, obj, tick_time=0.0):
+        """
+        Returns the message that brings this client up to date on obj:
+        a full update the first time, an ObjectDeltaMessage after that,
+        or None if nothing has changed, or the client can work it out.
+        tick_time is the time of the server's latest TICK, needed with extrapolate.
+        The message is taken as sent, see make_message() for one that may wait.
+        """
+        msg = self.make_message(obj, tick_time)
+        if msg is not None:
+            self.commit(msg)
+        return msg
+
+    def make_message(self, obj, tick_time=0.0):
+        """
+        As update_message(), but the client only has the message once
+        it is passed to commit().  Until then each message for obj
+        is made against what the client last got, so it replaces the
+        one before it.  Call it for obj every tick while one waits.
+        """
+        oid = obj.get_oid()
+        previous = self.sent.get(oid)
+        waiting = oid in self.unsent
+        moved = False
+        if previous is not None and self.extrapolate:
+            # where the client's values are by now
+            moved = extrapolate(previous, tick_time - self.sent_times[oid])
+            self.sent_times[oid] = tick_time
+        if previous is not None and not obj.get_changed() and not moved and not waiting:
+            return None
+        if previous is not None and self.missile_spawns and obj.is_missile() and obj.is_alive() and not waiting:
+            # still flying where the client expects it
+            return None
+        data = obj.get_message_data()
+        if previous is None:
+            self.unsent[oid] = tick_time
+            return object_to_message(obj)
+        fields = {}
+        for key in data:
+            if previous.get(key) != data[key]:
+                if self.extrapolate and is_extrapolated(key, previous.get(key), data[key]):
+                    continue
+                fields[key] = data[key]
+        if not fields:
+            if obj.is_dead():
+                self.forget(oid)
+            if not waiting:
+                return None
+            # the client is up to date, but for the message waiting
+        self.unsent[oid] = tick_time
+        return ObjectDeltaMessage(oid, fields)
+
+    def commit(self, msg):
+        """The client has been sent msg, the latest make_message() of its object."""
+        if msg.get_command() == M_OBJECT_DELTA:
+            oid = msg.get_oid()
+            fields = msg.get_fields()
+            self.unsent.pop(oid, None)
+            if fields.get('state') == STATE_DEAD:
+                self.forget(oid)
+            elif oid in self.sent:
+                self.sent[oid].update(fields)
+            return
+        oid = msg.data['oid']
+        tick_time = self.unsent.pop(oid, 0.0)
+        if msg.data['state'] != STATE_DEAD:
+            self.sent[oid] = dict(msg.data)
+            self.sent_times[oid] = tick_time
+        return
+
+    def assume_sent(self, obj, tick_time=0.0):
+        """The client already has obj, such as the walls of a map it
+           has cached: only later changes to it are sent."""
+        if not obj.is_dead():
+            self.sent[obj.get_oid()] = obj.get_message_data()
+            self.sent_times[obj.get_oid()] = tick_time
+        return
+
+    def forget(self, oid):
+        """The next update for oid will be a full one."""
+        if oid in self.sent:
+            del self.sent[oid]
+            del self.sent_times[oid]
+        return
+
+    def clear(self):
+        self.sent = {}
+        self.sent_times = {}
+        self.unsent = {}
+        return
+
+OBJECT_CLASSES = { M_PLAYER_UPDATE:  PlayerData,
+                   M_WALL_UPDATE:    WallData,
+                   M_NPC_UPDATE:     NPCData,
+                   M_MISSILE_UPDATE: MissileData }
 
 def message_to_object(msg):
+    if isinstance(msg, ObjectUpdateMessage) and msg.object is not None:
+        return msg.object
     code = msg.get_command()
-    if code == M_WALL_UPDATE:
-        obj = WallData()
-    elif code == M_NPC_UPDATE:
-        obj = NPCData()
-    elif code == M_MISSILE_UPDATE:
-        obj = MissileData()
-    elif code == M_PLAYER_UPDATE:
-        obj = PlayerData()
-    else:
-        obj = None
-    if obj:
-        obj.set_from_message(msg)
+    if not code in OBJECT_CLASSES:
+        return None
+    obj = OBJECT_CLASSES[code]()
+    obj.set_from_message(msg)
     return obj
 
-# 
-OBJECT_MESSAGES = { M_PLAYER_UPDATE:   string_to_player_update_message,
-                    M_WALL_UPDATE:     string_to_wall_update_message,
-                    M_NPC_UPDATE:      string_to_npc_update_message,
-                    M_MISSILE_UPDATE:  string_to_missile_update_message}
+def handle_object_update(engine, msg):
+    engine.update_object(message_to_object(msg))
+    return
+
+def handle_object_delta(engine, msg):
+    engine.apply_delta(msg.get_oid(), msg.get_fields(), msg.get_tick())
+    return
+
+register_client_handler(M_PLAYER_UPDATE,  handle_object_update)
+register_client_handler(M_WALL_UPDATE,    handle_object_update)
+register_client_handler(M_NPC_UPDATE,     handle_object_update)
+register_client_handler(M_MISSILE_UPDATE, handle_object_update)
+register_client_handler(M_OBJECT_DELTA,   handle_object_delta)
 
+OBJECT_MESSAGES = message_decoders([ PlayerUpdateMessage, WallUpdateMessage, NPCUpdateMessage,
+                                     MissileUpdateMessage, ObjectDeltaMessage ])
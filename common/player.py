@@ -71,10 +71,12 @@ class PlayerData(ObjectData):
 
     def set_experience(self, experience):
         self.experience = float(experience)
+        self.changed = True
         return
 
     def add_experience(self, new_experience):
         self.experience += new_experience
+        self.changed = True
         return
         
     def get_missile_range(self):
@@ -82,6 +84,7 @@ class PlayerData(ObjectData):
 
     def set_missile_range(self, mrange):
         self.missile_range = float(mrange)
+        self.changed = True
         return
         
     def get_missile_dx(self):
@@ -89,6 +92,7 @@ class PlayerData(ObjectData):
 
     def set_missile_dx(self, dx):
         self.missile_dx = float(dx)
+        self.changed = True
         return
         
     def get_missile_dy(self):
@@ -96,6 +100,7 @@ class PlayerData(ObjectData):
 
     def set_missile_dy(self, dy):
         self.missile_dy = float(dy)
+        self.changed = True
         return
 
     def get_missile_power(self):
@@ -103,6 +108,7 @@ class PlayerData(ObjectData):
 
     def set_missile_power(self, power):
         self.missile_power = float(power)
+        self.changed = True
         return
 
     def get_missile_mana(self):
@@ -110,6 +116,7 @@ class PlayerData(ObjectData):
 
     def set_missile_mana(self, mana):
         self.missile_mana = float(mana)
+        self.changed = True
         return
         
     def get_missile_mana_recharge_rate(self):
@@ -117,6 +124,7 @@ class PlayerData(ObjectData):
 
     def set_missile_mana_recharge_rate(self, mana_recharge_rate):
         self.missile_mana_recharge_rate = float(mana_recharge_rate)
+        self.changed = True
         return
         
     def get_missile_mana_max(self):
@@ -124,6 +132,7 @@ class PlayerData(ObjectData):
 
     def set_missile_mana_max(self, mana_max):
         self.missile_mana_max = float(mana_max)
+        self.changed = True
         return
 
     def get_move_mana(self):
@@ -131,6 +140,7 @@ class PlayerData(ObjectData):
 
     def set_move_mana(self, mana):
         self.move_mana = float(mana)
+        self.changed = True
         return
         
     def get_move_mana_recharge_rate(self):
@@ -138,6 +148,7 @@ class PlayerData(ObjectData):
 
     def set_move_mana_recharge_rate(self, mana_recharge_rate):
         self.move_mana_recharge_rate = float(mana_recharge_rate)
+        self.changed = True
         return
         
     def get_move_mana_max(self):
@@ -145,6 +156,7 @@ class PlayerData(ObjectData):
 
     def set_move_mana_max(self, mana_max):
         self.move_mana_max = float(mana_max)
+        self.changed = True
         return
 
     def is_player(self):
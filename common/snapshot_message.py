@@ -0,0 +1,59 @@
+#
+# One server tick of object updates and events, sent as a single frame.
+#
+from common.game_message import GameMessage, register_client_handler
+from common.message_schema import schema_message, message_decoders
+
+M_SNAPSHOT = "SNAPSHOT"
+M_TICK     = "TICK"
+
+class SnapshotMessage(GameMessage):
+    """
+    Bundles the object update and event messages of one server
+    tick.  GameComm frames the bundled messages inside the
+    SNAPSHOT frame with the same encoding they would have on
+    their own, and the client applies them all before the next
+    frame is drawn.  When the client accepted TICKS, the first
+    message is the TICK stamping the others.
+    """
+    def __init__(self, messages=None):
+        GameMessage.__init__(self, M_SNAPSHOT)
+        if messages is None:
+            messages = []
+        self.messages = messages
+        return
+
+    def add_message(self, msg):
+        self.messages.append(msg)
+        return
+
+    def get_messages(self):
+        return self.messages
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __str__(self):
+        return "SNAPSHOT[%s]" % (", ".join([ str(msg) for msg in self.messages ]))
+
+@schema_message(M_TICK, [ ('tick', 'int',    -1),
+                         ('time', 'double', 0.0) ])
+class TickMessage(GameMessage):
+    """
+    Starts one server tick: the object updates and events that
+    follow belong to it, until the next TICK.  tick increases by
+    one every server frame, time is the server's time.time().
+    """
+
+def handle_snapshot(engine, msg):
+    engine.apply_snapshot(msg)
+    return
+
+def handle_tick(engine, msg):
+    engine.set_tick(msg.get_tick(), msg.get_time())
+    return
+
+register_client_handler(M_SNAPSHOT, handle_snapshot)
+register_client_handler(M_TICK,     handle_tick)
+
+SNAPSHOT_MESSAGES = message_decoders([ TickMessage ])
@@ -0,0 +1,442 @@
+#
+# Connections that GameComm reads and writes frames through.
+#
+# GameComm only needs recv_into() and send(), with the semantics of a
+# non-blocking socket: socket.error EAGAIN when there is nothing to
+# read or no room to write, and 0 bytes read once the peer has closed.
+# ClientGameSocket also uses fileno() to select() on the connection.
+#
+# A transport is any object with the methods of a socket that are used:
+#   fileno()                 file descriptor to select() on, None if there is none
+#   readable()               without a file descriptor: True if recv_into() has data
+#   setblocking(flag)
+#   recv_into(buf, nbytes=0)
+#   send(data)
+#   close()
+# Sockets have them all but readable(), which SocketTransport adds.
+#
+import socket, errno, os, sys, stat, mmap, struct, tempfile
+
+# server_host prefix that selects a Unix domain socket, "unix:/tmp/game.sock"
+UNIX_PREFIX = "unix:"
+# server_host prefix that selects shared memory, set up over the server's
+# Unix domain socket, "shm:/tmp/game.sock"
+SHM_PREFIX = "shm:"
+# hosts with these prefixes are on this machine
+LOCAL_PREFIXES = ( UNIX_PREFIX, SHM_PREFIX )
+
+class SocketTransport:
+    """A connected TCP or Unix domain socket."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        return
+
+    def get_sock(self):
+        return self.sock
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def readable(self):
+        return False
+
+    def setblocking(self, flag):
+        self.sock.setblocking(flag)
+        return
+
+    def recv_into(self, buf, nbytes=0):
+        return self.sock.recv_into(buf, nbytes)
+
+    def send(self, data):
+        return self.sock.send(data)
+
+    def close(self):
+        self.sock.close()
+        return
+
+def connect_tcp(host, port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.connect( (host, port) )
+    # frames are already coalesced by GameComm, don't hold them back
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return SocketTransport(sock)
+
+def connect_unix(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    return SocketTransport(sock)
+
+def listen_unix(path, backlog=5):
+    """returns a listening Unix domain socket for the server; accept() as usual"""
+    if os.path.exists(path):
+        os.unlink(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(backlog)
+    return sock
+
+def connect_transport(host, port):
+    """connects to "unix:path" with a Unix domain socket, "shm:path" with
+       shared memory, anything else with TCP"""
+    if host.startswith(UNIX_PREFIX):
+        return connect_unix(host[len(UNIX_PREFIX):])
+    if host.startswith(SHM_PREFIX):
+        return connect_shm(host[len(SHM_PREFIX):])
+    return connect_tcp(host, port)
+
+def accept_transport(listen_sock, timeout=None):
+    """
+    Accepts a client on a listening Unix domain socket, as a ShmTransport
+    if the client asks for shared memory, a SocketTransport otherwise.
+    Waits at most timeout seconds, SHM_HANDSHAKE_TIMEOUT by default, for
+    the client's first bytes and any shared memory request, so that a
+    silent client holds up other accepts no longer than that.
+    Raises socket.error if the client fails the handshake.
+    """
+    if timeout is None:
+        timeout = SHM_HANDSHAKE_TIMEOUT
+    sock, address = listen_sock.accept()
+    try:
+        sock.settimeout(timeout)
+        if sock.recv(len(SHM_HELLO), socket.MSG_PEEK) == SHM_HELLO:
+            transport = accept_shm(sock)
+        else:
+            transport = SocketTransport(sock)
+        sock.settimeout(None)
+    except socket.error:
+        sock.close()
+        raise
+    return transport
+
+class LoopbackTransport:
+    """
+    One end of an in-process connection, made by loopback_pair().
+    send() appends straight to the peer's input, there is no kernel
+    and no file descriptor: poll readable() instead of select().
+    Always non-blocking, as nothing could arrive while waiting.
+    """
+
+    # compact the input once this much of it has been read
+    COMPACT_SIZE = 65536
+
+    def __init__(self):
+        self.peer = None
+        self.incoming = bytearray() # bytes sent by the peer
+        self.read_pos = 0           # offset of the first unread byte in incoming
+        self.closed = False
+        return
+
+    def set_peer(self, peer):
+        self.peer = peer
+        return
+
+    def fileno(self):
+        return None
+
+    def readable(self):
+        return self.read_pos < len(self.incoming) or self.peer is None or self.peer.closed
+
+    def setblocking(self, flag):
+        return
+
+    def recv_into(self, buf, nbytes=0):
+        if self.closed:
+            raise socket.error(errno.EBADF, "Bad file descriptor")
+        if nbytes == 0 or nbytes > len(buf):
+            nbytes = len(buf)
+        n = min(nbytes, len(self.incoming) - self.read_pos)
+        if n == 0:
+            if self.peer is None or self.peer.closed:
+                return 0
+            raise socket.error(errno.EAGAIN, "Resource temporarily unavailable")
+        buf[0:n] = self.incoming[self.read_pos:self.read_pos + n]
+        self.read_pos += n
+        if self.read_pos == len(self.incoming):
+            del self.incoming[:]
+            self.read_pos = 0
+        elif self.read_pos >= self.COMPACT_SIZE:
+            del self.incoming[:self.read_pos]
+            self.read_pos = 0
+        return n
+
+    def send(self, data):
+        if self.closed or self.peer is None or self.peer.closed:
+            raise socket.error(errno.EPIPE, "Broken pipe")
+        self.peer.incoming += data
+        return len(data)
+
+    def close(self):
+        self.closed = True
+        return
+
+def loopback_pair():
+    """returns two connected LoopbackTransport ends, client and server"""
+    a = LoopbackTransport()
+    b = LoopbackTransport()
+    a.set_peer(b)
+    b.set_peer(a)
+    return a, b
+
+####################################################################
+#
+# Shared memory: one file mapped by both processes, holding a single
+# producer, single consumer ring buffer for each direction.  The Unix
+# domain socket used to set it up stays open: each send() puts one
+# byte on it to wake the peer's select(), and it reports a peer that
+# went away.
+#
+# The ring positions are written after the data they cover; this
+# relies on the stores being seen in order, as on x86.  Python 2 mmap
+# only copies through str, so each direction costs two copies in user
+# space, and none in the kernel.
+#
+
+# first bytes a client sends on the Unix domain socket: "SHM path size\n"
+SHM_HELLO = "SHM "
+SHM_OK = "OK\n"
+# bytes of frame data each ring holds
+SHM_RING_SIZE = 1048576
+# largest ring a client may ask for
+SHM_MAX_RING_SIZE = 64 * SHM_RING_SIZE
+# where the shared file is made, memory backed if possible
+SHM_DIR = "/dev/shm"
+# name prefix of the shared file, the server maps no other file
+SHM_FILE_PREFIX = "gamecomm-"
+# seconds the server waits for a client's first bytes and request
+SHM_HANDSHAKE_TIMEOUT = 2.0
+
+# ring header: total bytes written, total bytes read, writer has closed
+RING_HEADER = struct.Struct('<QQB')
+RING_HEADER_SIZE = 64
+
+class ShmRing:
+    """One direction of a ShmTransport, at offset base of the mapping."""
+
+    def __init__(self, mm, base, size):
+        self.mm = mm
+        self.base = base                 # offset of the header
+        self.start = base + RING_HEADER_SIZE # offset of the data
+        self.size = size
+        return
+
+    def _positions(self):
+        head, tail, closed = RING_HEADER.unpack_from(self.mm, self.base)
+        return head, tail
+
+    def get_used(self):
+        head, tail = self._positions()
+        return head - tail
+
+    def is_closed(self):
+        return RING_HEADER.unpack_from(self.mm, self.base)[2] != 0
+
+    def set_closed(self):
+        struct.pack_into('<B', self.mm, self.base + 16, 1)
+        return
+
+    def write(self, data):
+        """copies in as much of data as fits, returns the number of bytes"""
+        head, tail = self._positions()
+        n = min(len(data), self.size - (head - tail))
+        if n <= 0:
+            return 0
+        offset = head % self.size
+        first = min(n, self.size - offset)
+        self.mm[self.start + offset:self.start + offset + first] = str(data[:first])
+        if first < n:
+            self.mm[self.start:self.start + n - first] = str(data[first:n])
+        struct.pack_into('<Q', self.mm, self.base, head + n)
+        return n
+
+    def read_into(self, buf, nbytes):
+        """copies up to nbytes into buf, returns the number of bytes"""
+        head, tail = self._positions()
+        n = min(nbytes, head - tail)
+        if n <= 0:
+            return 0
+        offset = tail % self.size
+        first = min(n, self.size - offset)
+        buf[0:first] = self.mm[self.start + offset:self.start + offset + first]
+        if first < n:
+            buf[first:n] = self.mm[self.start:self.start + n - first]
+        struct.pack_into('<Q', self.mm, self.base + 8, tail + n)
+        return n
+
+class ShmTransport:
+    """
+    Frames carried through shared memory rings, with the Unix domain
+    socket sock used only for wakeups.  Made by connect_shm() on the
+    client and accept_shm() on the server.
+    """
+
+    def __init__(self, mm, ring_size, is_client, sock):
+        self.mm = mm
+        self.sock = sock
+        # only wakeups are read from it, never waiting
+        self.sock.setblocking(0)
+        to_server = ShmRing(mm, 0, ring_size)
+        to_client = ShmRing(mm, RING_HEADER_SIZE + ring_size, ring_size)
+        if is_client:
+            self.ring_in, self.ring_out = to_client, to_server
+        else:
+            self.ring_in, self.ring_out = to_server, to_client
+        self.peer_gone = False
+        self.closed = False
+        return
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def readable(self):
+        return self.ring_in.get_used() > 0
+
+    def setblocking(self, flag):
+        # waiting is done by select() on the socket
+        return
+
+    def _drain_wakeups(self):
+        try:
+            while not self.peer_gone:
+                if not self.sock.recv(4096):
+                    self.peer_gone = True
+        except socket.error as e:
+            if e.errno == errno.ECONNRESET:
+                self.peer_gone = True
+            elif e.errno != errno.EAGAIN:
+                raise e
+        return
+
+    def recv_into(self, buf, nbytes=0):
+        if self.closed:
+            raise socket.error(errno.EBADF, "Bad file descriptor")
+        if nbytes == 0 or nbytes > len(buf):
+            nbytes = len(buf)
+        n = self.ring_in.read_into(buf, nbytes)
+        if n > 0:
+            # wakeups are left unread while there is data, so select() still fires
+            return n
+        # the ring is checked again after draining, so a wakeup is never lost
+        self._drain_wakeups()
+        n = self.ring_in.read_into(buf, nbytes)
+        if n > 0:
+            return n
+        if self.peer_gone or self.ring_in.is_closed():
+            return 0
+        raise socket.error(errno.EAGAIN, "Resource temporarily unavailable")
+
+    def send(self, data):
+        if self.closed or self.peer_gone:
+            raise socket.error(errno.EPIPE, "Broken pipe")
+        n = self.ring_out.write(data)
+        if n == 0:
+            raise socket.error(errno.EAGAIN, "Resource temporarily unavailable")
+        try:
+            self.sock.send("\0")
+        except socket.error as e:
+            # a full socket already holds a wakeup the peer has not read
+            if e.errno != errno.EAGAIN:
+                raise e
+        return n
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.ring_out.set_closed()
+        self.sock.close()
+        self.mm.close()
+        return
+
+def shm_mapping_size(ring_size):
+    return 2 * (RING_HEADER_SIZE + ring_size)
+
+def connect_shm(path, ring_size=SHM_RING_SIZE):
+    """connects to the server's Unix domain socket at path, and moves the frames to shared memory"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    directory = None
+    if os.path.isdir(SHM_DIR):
+        directory = SHM_DIR
+    fd, name = tempfile.mkstemp(prefix=SHM_FILE_PREFIX, dir=directory)
+    try:
+        os.ftruncate(fd, shm_mapping_size(ring_size))
+        mm = mmap.mmap(fd, shm_mapping_size(ring_size))
+        sock.sendall("%s%s %d\n" % (SHM_HELLO, name, ring_size))
+        reply = _recv_line(sock)
+        if reply != SHM_OK:
+            sock.close()
+            mm.close()
+            raise socket.error(errno.ECONNREFUSED, "Shared memory refused: %r" % (reply))
+    finally:
+        # both ends have it mapped, or never will
+        os.close(fd)
+        os.unlink(name)
+    return ShmTransport(mm, ring_size, True, sock)
+
+def _shm_dirs():
+    """the directories connect_shm() may make its file in"""
+    return [ os.path.realpath(d) for d in (SHM_DIR, tempfile.gettempdir()) ]
+
+# SO_PEERCRED, which the socket module of Python 2 lacks, on Linux
+SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17)
+
+def _peer_uid(sock):
+    """the user id of the process at the other end of a Unix domain socket.
+       Raises ValueError where the system does not tell."""
+    if not hasattr(socket, 'SO_PEERCRED') and not sys.platform.startswith('linux'):
+        raise ValueError("the peer's user id is unknown")
+    try:
+        creds = sock.getsockopt(socket.SOL_SOCKET, SO_PEERCRED, struct.calcsize('3i'))
+    except socket.error as e:
+        raise ValueError("the peer's user id is unknown: %s" % (e))
+    return struct.unpack('3i', creds)[1]
+
+def _open_shm(sock, name, ring_size):
+    """
+    Opens the client's shared file, only if it is one connect_shm() makes:
+    a regular file named SHM_FILE_PREFIX... in one of _shm_dirs(), owned
+    by the client, and of the size of its rings.  Returns the descriptor.
+    """
+    if (not os.path.isabs(name) or os.path.realpath(os.path.dirname(name)) not in _shm_dirs()
+        or not os.path.basename(name).startswith(SHM_FILE_PREFIX)):
+        raise ValueError("not a shared memory file: %r" % (name))
+    if not 0 < ring_size <= SHM_MAX_RING_SIZE:
+        raise ValueError("bad ring size %d" % (ring_size))
+    fd = os.open(name, os.O_RDWR | getattr(os, 'O_NOFOLLOW', 0))
+    info = os.fstat(fd)
+    if (not stat.S_ISREG(info.st_mode) or info.st_size != shm_mapping_size(ring_size)
+        or info.st_uid != _peer_uid(sock)):
+        os.close(fd)
+        raise ValueError("not the client's shared memory file: %r" % (name))
+    return fd
+
+def accept_shm(sock):
+    """server side of connect_shm(), on a just accepted Unix domain socket.
+       Raises socket.error, with sock closed, if the request is refused."""
+    line = _recv_line(sock)
+    words = line[len(SHM_HELLO):].split()
+    try:
+        if not line.startswith(SHM_HELLO) or len(words) != 2:
+            raise ValueError("bad request")
+        name, ring_size = words[0], int(words[1])
+        fd = _open_shm(sock, name, ring_size)
+        try:
+            mm = mmap.mmap(fd, shm_mapping_size(ring_size))
+        finally:
+            os.close(fd)
+    except (ValueError, EnvironmentError, mmap.error) as e:
+        sock.close()
+        raise socket.error(errno.EPROTO, "Bad shared memory request %r: %s" % (line, e))
+    sock.sendall(SHM_OK)
+    return ShmTransport(mm, ring_size, False, sock)
+
+def _recv_line(sock):
+    """reads one short line, byte by byte so nothing after it is consumed"""
+    line = ""
+    while not line.endswith("\n") and len(line) < 4096:
+        c = sock.recv(1)
+        if not c:
+            break
+        line += c
+    return line
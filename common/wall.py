@@ -1,7 +1,8 @@
 #
 # Don't change this file
 #
-from object import ObjectData
+import hashlib
+from object import ObjectData, quantize
 class WallData(ObjectData):
     """
     All data associated with game Wall objects
@@ -14,3 +15,15 @@ class WallData(ObjectData):
     def is_wall(self):
         return True
 
+def walls_hash(walls):
+    """
+    Names a map by its walls, whatever their order: the server sends
+    it in GAME_STARTING, the client checks the walls it caches against it.
+    Coordinates are hashed at the precision every encoding keeps, so
+    the walls a client decodes hash as the server's do.
+    """
+    lines = sorted([ "%d %d %d %d %d" % (w.get_oid(), quantize(w.get_x()), quantize(w.get_y()),
+                                         quantize(w.get_w()), quantize(w.get_h()))
+                     for w in walls ])
+    return hashlib.sha1("\n".join(lines)).hexdigest()
+
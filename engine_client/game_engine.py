@@ -11,6 +11,10 @@
 #   get_winner_name() return the winner's name, if there is a winner
 #   get_object(oid) return the object identified by oid
 #   get_objects() return the dictionary of all objects
+#   get_tick() return the latest server tick number, -1 if the server sends none
+#   get_staleness() return (ticks, milliseconds) since the latest tick arrived
+#   get_object_staleness(oid) return (ticks, milliseconds) since the object was last updated
+#   get_stale_updates() return the number of out of date updates dropped
 
 
 # Action methods on the game engine:
@@ -38,12 +42,24 @@
 # 
 # 
 
-import logging
+import logging, time
 from common.game import GameData
-from common.object_message import message_to_object
-from common.event_message import message_to_event
+# the message modules register their handlers in CLIENT_HANDLERS
+import common.object_message
+import common.event_message
+import common.snapshot_message
 from common.command_message import *
 from common.game_message import *
+from common.game_comm import C_PIPELINED_LOGIN, uses_missile_spawns, uses_extrapolation
+from common.extrapolation import extrapolate
+from common.wall import walls_hash
+
+# seconds before an unchanged setting is sent again: the server may
+# have refused or overridden it, such as a speed without the mana for it
+KEEP_ALIVE = 1.0
+
+# settings a fired missile uses, sent ahead of FIRE_MISSILE
+FIRE_DEPENDENCIES = [ M_SET_MISSILE_RANGE, M_SET_MISSILE_POWER, M_SET_MISSILE_DIRECTION ]
 
 MODE_DUAL = 1
 MODE_SINGLE = 2
@@ -51,6 +67,13 @@ MODE_AI = 3
 MODE_TOURNAMENT = 4
 MODE_VIEW = 5
 
+# the message that asks the server for each mode
+MODE_REQUESTS = { MODE_DUAL:       RequestDualMessage,
+                  MODE_SINGLE:     RequestSingleMessage,
+                  MODE_AI:         RequestAiMessage,
+                  MODE_TOURNAMENT: RequestTournamentMessage,
+                  MODE_VIEW:       RequestViewMessage }
+
 class ClientGameEngine:
     """
     Stores game information for client.
@@ -64,25 +87,60 @@ class ClientGameEngine:
     # Internal methods that should not be exposed
     # to the client.
     #
-    def __init__(self, name, desired_mode=MODE_DUAL):
+    def __init__(self, name, desired_mode=MODE_DUAL, keep_alive=KEEP_ALIVE, map_cache=None):
         self.logger = logging.getLogger('ClientGameEngine')
         self.logger.debug('__init__')
         self.desired_mode = desired_mode
+        self.keep_alive = keep_alive # seconds before an unchanged setting is sent again, None for never
+        self.priority_callback = None # called when a latency-critical message is queued
+        self.missile_spawns = False   # True if live missiles are moved here, see MISSILE_SPAWNS
+        self.extrapolation = False    # True if mana and dying_percent are advanced here, see EXTRAPOLATION
+        self.map_cache = map_cache    # engine_client.map_cache.MapCache of walls already seen, or None
         self.new_game(name)
         return
 
     def new_game(self, name):
         self.logger.debug('new_game')
+        self.reset_game(name)
+        msg = GameMessageLogin()
+        msg.set_user(self.data.get_name())
+        msg.set_request(True)
+        if self.desired_mode in MODE_REQUESTS:
+            # a server that accepts PIPELINED_LOGIN starts on this without waiting for us
+            msg.set_mode_request(MODE_REQUESTS[self.desired_mode]().get_command())
+        self.add_message(msg)
+        return
+
+    def next_game(self, desired_mode):
+        """
+        Starts another game on a connection the server kept logged in
+        (SESSIONS), or on a new channel of one (CHANNELS): only the
+        mode request is sent.
+        """
+        self.logger.debug('next_game')
+        self.desired_mode = desired_mode
+        self.reset_game(self.data.get_name())
+        self.data.set_logged_in()
+        self.request_mode()
+        return
+
+    def reset_game(self, name):
         self.data = GameData()
         self.data.set_name(name)
         self.player_oid = -1
         self.opponent_oid = -1
         self.message_queue = []
+        self.priority_queue = [] # sent before message_queue, as soon as possible
         self.event_queue = []
-        msg = GameMessageLogin()
-        msg.set_user(self.data.get_name())
-        msg.set_request(True)
-        self.add_message(msg)
+        self.sent_settings = {}  # (value, time sent) of the last command of each setting, by message class
+        self.tick = -1           # latest server tick, -1 until the server sends one
+        self.tick_time = 0.0     # server time of that tick
+        self.tick_received = 0.0 # local time that tick arrived
+        self.tick_interval = 0.0 # smoothed server seconds per tick
+        self.stale_updates = 0   # updates dropped for being older than the object
+        self.newest_tick = -1    # highest server tick handled so far
+        self.map_hash = None     # hash of the map whose walls are arriving, to cache them
+        self.map_walls = {}      # those walls so far, by oid
         return
 
     def add_message(self, msg):
@@ -91,15 +149,60 @@ class ClientGameEngine:
 
     def get_message_queue(self):
         return self.message_queue
+
+    def add_priority_message(self, msg):
+        """
+        Queues a latency-critical message, with the queued settings
+        it depends on moved ahead of it, and asks for them to be
+        sent now rather than at the next frame.
+        """
+        if msg.get_command() == M_FIRE_MISSILE:
+            needed = [ m for m in self.message_queue if m.get_command() in FIRE_DEPENDENCIES ]
+            if needed:
+                self.message_queue = [ m for m in self.message_queue if m.get_command() not in FIRE_DEPENDENCIES ]
+                self.priority_queue.extend(needed)
+        self.priority_queue.append(msg)
+        if self.priority_callback is not None:
+            self.priority_callback()
+        return
+
+    def get_priority_queue(self):
+        return self.priority_queue
+
+    def clear_priority_queue(self):
+        self.priority_queue = []
+        return
+
+    def set_priority_callback(self, callback):
+        """callback() should send the priority queue, see ClientGameSocket.send_priority_messages()"""
+        self.priority_callback = callback
+        return
+
+    def add_setting(self, message_class, value):
+        """
+        Queues message_class(value), unless the last command sent
+        for this setting had the same value.  With keep_alive set,
+        an unchanged value is sent again once that many seconds
+        have passed.
+        """
+        now = time.time()
+        if message_class in self.sent_settings:
+            (last_value, last_time) = self.sent_settings[message_class]
+            if last_value == value and (self.keep_alive is None or
+                                        now - last_time < self.keep_alive):
+                return
+        self.sent_settings[message_class] = (value, now)
+        self.add_message(message_class(value))
+        return
+
+    def set_keep_alive(self, keep_alive):
+        self.keep_alive = keep_alive
+        return
         
     def clear_message_queue(self):
         self.message_queue = []
         return
 
-    def add_event(self, event):
-        self.event_queue.append(event)
-        return
-        
     def get_event_queue(self):
         return self.event_queue
         
@@ -109,66 +212,207 @@ class ClientGameEngine:
 
     def process_server_message(self, msg):
         """
-        Handles object update messages.
-        Other message types should be handled as well.
+        Handles a message from the server, with the handler
+        registered for its code by the message modules.
+        Add handlers with register_client_handler().
         """
-        self.logger.debug('process_server_message')
-        obj = message_to_object(msg)
-        event = message_to_event(msg)
+        code = msg.get_command()
+        if not code in CLIENT_HANDLERS:
+            self.logger.error("Unknown message type: %s", msg)
+            return
+        CLIENT_HANDLERS[code](self, msg)
+        return
+
+    def set_tick(self, tick, tick_time):
+        """A TICK message: the updates that follow are from this server tick."""
+        if self.tick >= 0 and tick > self.tick:
+            interval = (tick_time - self.tick_time) / (tick - self.tick)
+            if self.tick_interval > 0:
+                interval = 0.9 * self.tick_interval + 0.1 * interval
+            self.tick_interval = interval
+        self.tick = tick
+        self.tick_time = tick_time
+        self.tick_received = time.time()
+        self.newest_tick = max(self.newest_tick, tick)
+        if self.missile_spawns or self.extrapolation:
+            self.advance_objects(tick, tick_time)
+        return
+
+    def advance_objects(self, tick, tick_time):
+        """Brings on to tick what the server changes without telling us:
+           live missiles with MISSILE_SPAWNS, the fields of
+           common.extrapolation with EXTRAPOLATION."""
+        for obj in self.data.get_objects().values():
+            if not 0 <= obj.get_tick() < tick:
+                continue
+            flying = self.missile_spawns and obj.is_missile() and obj.is_alive()
+            if not flying and not self.extrapolation:
+                continue
+            seconds = tick_time - obj.get_tick_time()
+            if flying:
+                obj.advance(seconds)
+            if self.extrapolation:
+                extrapolate(obj.__dict__, seconds)
+            obj.set_tick(tick, tick_time)
+        return
+
+    def set_missile_spawns(self, missile_spawns):
+        """True if the server only sends missiles at spawn and end."""
+        self.missile_spawns = missile_spawns
+        return
+
+    def set_extrapolation(self, extrapolation):
+        """True if the server leaves out mana and dying_percent while they follow their rates."""
+        self.extrapolation = extrapolation
+        return
+
+    def is_stale(self, obj, tick=-1):
+        """
+        True if obj already holds an update newer than tick, the tick
+        of the update at hand, -1 for the current tick.  It is only
+        counted if that newer update was handled already: one decoded
+        in place ahead of its turn, later in the same batch, is not.
+        """
+        if tick < 0:
+            tick = self.tick
+        if obj is not None and obj.get_tick() > tick:
+            if obj.get_tick() <= self.newest_tick:
+                self.stale_updates += 1
+                self.logger.debug("Stale update of %d: tick %d < %d", obj.get_oid(), tick, obj.get_tick())
+            return True
+        return False
+
+    def update_object(self, obj):
+        self.logger.info('update_object:(%s)', obj)
+        stored = self.data.get_object(obj.get_oid())
+        if stored is not obj and self.is_stale(stored):
+            return
+        # decoded in place, obj may already hold a later update of this
+        # batch, and carry its tick: that update stamps it when its turn comes
+        if obj.get_tick() <= self.tick:
+            obj.set_tick(self.tick, self.tick_time)
+        self.data.update_object(obj)
+        self.object_updated(obj)
+        if self.map_hash is not None and obj.is_wall():
+            self.map_walls[obj.get_oid()] = obj
+            # the map is complete when its walls hash to its name
+            if walls_hash(self.map_walls.values()) == self.map_hash:
+                self.store_map()
+        return
+
+    def apply_delta(self, oid, fields, tick=-1):
+        """tick is the server tick the delta was read under, -1 if unknown"""
+        if self.is_stale(self.data.get_object(oid), tick):
+            return
+        obj = self.data.apply_delta(oid, fields)
         if obj is not None:
-            self.logger.info('update_object:(%s)', obj)
-            self.data.update_object(obj)
-            if (self.player_oid > 0 and
-                self.opponent_oid < 0 and
-                obj.is_player() and
-                self.player_oid != obj.get_oid()):
-                self.opponent_oid = obj.get_oid()
-            if obj.is_dead() and obj.is_player():
-                if obj.get_oid() == self.opponent_oid:
-                    self.opponent_oid = -1
-                elif obj.get_oid() == self.player_oid:
-                    self.player_oid = -1
-        elif event is not None:
-            self.logger.info('event:(%s)', event)
-            self.add_event(event)
+            obj.set_tick(self.tick, self.tick_time)
+            self.object_updated(obj)
+        else:
+            self.logger.warning("Delta for unknown object: %s", oid)
+        return
+
+    def add_event(self, event):
+        self.logger.info('event:(%s)', event)
+        self.event_queue.append(event)
+        return
+
+    def set_player_oid(self, oid):
+        self.player_oid = oid
+        return
+
+    def logged_in(self, msg):
+        """The server accepted the login, ask for the desired game,
+           unless the server took the request from the login itself."""
+        self.data.set_logged_in()
+        self.set_missile_spawns(uses_missile_spawns(msg.get_capabilities()))
+        self.set_extrapolation(uses_extrapolation(msg.get_capabilities()))
+        if C_PIPELINED_LOGIN in msg.get_capabilities():
+            return
+        self.request_mode()
+        return
+
+    def request_mode(self):
+        if self.desired_mode in MODE_REQUESTS:
+            self.add_message(MODE_REQUESTS[self.desired_mode]())
+        else:
+            self.logger.error("Unknown mode: %d", self.desired_mode)
+        return
+
+    def game_starting(self, msg):
+        # the server starts the new game's settings from scratch
+        self.sent_settings = {}
+        self.data.set_game_started()
+        self.data.set_opponent_name(msg.get_opponent_name())
+        if msg.get_player_oid() > 0:
+            self.set_player_oid(msg.get_player_oid())
         else:
-            code = msg.get_command()
-            if code == M_PLAYER_OID:
-                self.player_oid = msg.get_oid()
-            elif code == M_LOGIN:
-                if (not msg.get_request()) and msg.get_result():
-                    self.data.set_logged_in()
-                    if self.desired_mode == MODE_DUAL:
-                        self.add_message(RequestDualMessage())
-                    elif self.desired_mode == MODE_SINGLE:
-                        self.add_message(RequestSingleMessage())
-                    elif self.desired_mode == MODE_TOURNAMENT:
-                        self.add_message(RequestTournamentMessage())
-                    elif self.desired_mode == MODE_AI:
-                        self.add_message(RequestAiMessage())
-                    elif self.desired_mode == MODE_VIEW:
-                        self.add_message(RequestViewMessage())
-                    else:
-                        self.logger.error("Unknown mode: %d", self.desired_mode)
-            elif code == M_WAIT_FOR_DUAL:
-                self.data.set_waiting_for_dual()
-            elif code == M_WAIT_FOR_SINGLE:
-                self.data.set_waiting_for_single()
-            elif code == M_WAIT_FOR_TOURNAMENT:
-                self.data.set_waiting_for_tournament()
-            elif code == M_WAIT_FOR_AI:
-                self.data.set_waiting_for_ai()
-            elif code == M_WAIT_FOR_VIEW:
-                self.data.set_waiting_for_view()
-            elif code == M_GAME_STARTING:
-                self.data.set_game_started()
-                self.data.set_opponent_name(msg.get_opponent_name())
-                self.add_message(RequestPlayerOidMessage())
-            elif code == M_GAME_OVER:
-                self.data.set_game_over()
-                self.data.set_winner_name(msg.get_winner_name())
-            else:
-                self.logger.error("Unknown message type: %s", msg)
+            # older servers only send it when asked
+            self.add_message(RequestPlayerOidMessage())
+        if msg.get_map_hash() is not None:
+            self.load_map(msg.get_map_hash())
+        return
+
+    def game_over(self, msg):
+        self.data.set_game_over()
+        self.data.set_winner_name(msg.get_winner_name())
+        # an incomplete map is not cached
+        self.map_hash = None
+        self.map_walls = {}
+        return
+
+    def load_map(self, map_hash):
+        """
+        GAME_STARTING named the map: the walls come from the cache,
+        or are collected for it as they arrive.  The server waits
+        for the answer before sending them.
+        """
+        walls = None
+        if self.map_cache is not None:
+            walls = self.map_cache.get_walls(map_hash)
+            if walls is None:
+                self.map_hash = map_hash
+                self.map_walls = {}
+        if walls is not None:
+            for wall in walls:
+                self.update_object(wall)
+        self.add_priority_message(HaveMapMessage(map_hash, walls is not None))
+        return
+
+    def store_map(self):
+        self.map_cache.put_walls(self.map_hash, self.map_walls.values())
+        self.map_hash = None
+        self.map_walls = {}
+        return
+
+    def set_map_cache(self, map_cache):
+        self.map_cache = map_cache
+        return
+
+    def get_map_cache(self):
+        return self.map_cache
+
+    def apply_snapshot(self, snapshot):
+        """
+        Applies every update and event of one server tick, in order,
+        before returning.  The display never sees part of a tick.
+        """
+        for msg in snapshot.get_messages():
+            self.process_server_message(msg)
+        return
+
+    def object_updated(self, obj):
+        """Tracks the player and opponent oids as objects change."""
+        if (self.player_oid > 0 and
+            self.opponent_oid < 0 and
+            obj.is_player() and
+            self.player_oid != obj.get_oid()):
+            self.opponent_oid = obj.get_oid()
+        if obj.is_dead() and obj.is_player():
+            if obj.get_oid() == self.opponent_oid:
+                self.opponent_oid = -1
+            elif obj.get_oid() == self.player_oid:
+                self.player_oid = -1
         return
 
     def __str__(self):
@@ -198,6 +442,31 @@ class ClientGameEngine:
         return self.data.get_object(oid)
     def get_objects(self):
         return self.data.get_objects()
+    def get_tick(self):
+        return self.tick
+    def get_staleness(self):
+        """
+        (ticks, milliseconds) since the latest tick arrived, by the
+        local clock.  Network delay is not included, as the clocks
+        of client and server are not compared.
+        """
+        if self.tick < 0:
+            return (0, 0.0)
+        ms = (time.time() - self.tick_received) * 1000.
+        ticks = 0
+        if self.tick_interval > 0:
+            ticks = int(ms / 1000. / self.tick_interval)
+        return (ticks, ms)
+    def get_object_staleness(self, oid):
+        """(ticks, milliseconds) since the object's last update, None if unknown"""
+        obj = self.data.get_object(oid)
+        if obj is None or obj.get_tick() < 0:
+            return None
+        (ticks, ms) = self.get_staleness()
+        return (self.tick - obj.get_tick() + ticks,
+                (self.tick_time - obj.get_tick_time()) * 1000. + ms)
+    def get_stale_updates(self):
+        return self.stale_updates
 
     #
     # Game Action Methods
@@ -205,57 +474,57 @@ class ClientGameEngine:
     
     # move speed
     def set_player_speed_stop(self):
-        self.add_message(SetPlayerSpeedMessage(T_SPEED_STOP))
+        self.add_setting(SetPlayerSpeedMessage, T_SPEED_STOP)
         return
     def set_player_speed_slow(self):
-        self.add_message(SetPlayerSpeedMessage(T_SPEED_SLOW))
+        self.add_setting(SetPlayerSpeedMessage, T_SPEED_SLOW)
         return
     def set_player_speed_medium(self):
-        self.add_message(SetPlayerSpeedMessage(T_SPEED_MEDIUM))
+        self.add_setting(SetPlayerSpeedMessage, T_SPEED_MEDIUM)
         return
     def set_player_speed_fast(self):
-        self.add_message(SetPlayerSpeedMessage(T_SPEED_FAST))
+        self.add_setting(SetPlayerSpeedMessage, T_SPEED_FAST)
         return
         
     # move direction
     def set_player_direction(self, degrees):
-        self.add_message(SetPlayerDirectionMessage(degrees))
+        self.add_setting(SetPlayerDirectionMessage, degrees)
         return
 
     # missile range
     def set_missile_range_none(self):
-        self.add_message(SetMissileRangeMessage(T_RANGE_NONE))
+        self.add_setting(SetMissileRangeMessage, T_RANGE_NONE)
         return
     def set_missile_range_short(self):
-        self.add_message(SetMissileRangeMessage(T_RANGE_SHORT))
+        self.add_setting(SetMissileRangeMessage, T_RANGE_SHORT)
         return
     def set_missile_range_medium(self):
-        self.add_message(SetMissileRangeMessage(T_RANGE_MEDIUM))
+        self.add_setting(SetMissileRangeMessage, T_RANGE_MEDIUM)
         return
     def set_missile_range_long(self):
-        self.add_message(SetMissileRangeMessage(T_RANGE_LONG))
+        self.add_setting(SetMissileRangeMessage, T_RANGE_LONG)
         return
         
     # missile direction
     def set_missile_direction(self, degrees):
-        self.add_message(SetMissileDirectionMessage(degrees))
+        self.add_setting(SetMissileDirectionMessage, degrees)
         return
         
     # missile power
     def set_missile_power_none(self):
-        self.add_message(SetMissilePowerMessage(T_POWER_NONE))
+        self.add_setting(SetMissilePowerMessage, T_POWER_NONE)
         return
     def set_missile_power_low(self):
-        self.add_message(SetMissilePowerMessage(T_POWER_LOW))
+        self.add_setting(SetMissilePowerMessage, T_POWER_LOW)
         return
     def set_missile_power_medium(self):
-        self.add_message(SetMissilePowerMessage(T_POWER_MEDIUM))
+        self.add_setting(SetMissilePowerMessage, T_POWER_MEDIUM)
         return
     def set_missile_power_high(self):
-        self.add_message(SetMissilePowerMessage(T_POWER_HIGH))
+        self.add_setting(SetMissilePowerMessage, T_POWER_HIGH)
         return
         
     # fire missile
     def fire_missile(self):
-        self.add_message(FireMissileMessage())
+        self.add_priority_message(FireMissileMessage())
         return
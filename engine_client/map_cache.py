@@ -0,0 +1,87 @@
+#
+# Walls of the maps already seen, keyed by the map hash the server
+# sends in GAME_STARTING, so that they are not downloaded again.
+#
+import os, json, copy, logging, tempfile
+from common.wall import walls_hash
+from common.object_message import WallUpdateMessage
+
+class MapCache:
+    """
+    Keeps the walls of each map in memory, and in one JSON file
+    per map in directory, if given, for later runs of the client.
+    One MapCache may be shared by any number of engines.
+    Objects are copied in and out, engines never share walls.
+    """
+
+    def __init__(self, directory=None):
+        self.logger = logging.getLogger('MapCache')
+        self.directory = directory
+        self.maps = {}   # map hash -> list of WallData
+        return
+
+    def get_directory(self):
+        return self.directory
+
+    def _path(self, map_hash):
+        return os.path.join(self.directory, "%s.json" % (map_hash))
+
+    def has_map(self, map_hash):
+        return self.get_walls(map_hash) is not None
+
+    def get_walls(self, map_hash):
+        """Returns copies of the walls of map_hash, or None if not cached."""
+        if not map_hash in self.maps:
+            walls = self._load(map_hash)
+            if walls is None:
+                return None
+            self.maps[map_hash] = walls
+        return [ copy.copy(wall) for wall in self.maps[map_hash] ]
+
+    def put_walls(self, map_hash, walls):
+        """Caches walls for map_hash, if they really hash to it.
+           Returns True if cached."""
+        walls = [ copy.copy(wall) for wall in walls ]
+        if walls_hash(walls) != map_hash:
+            self.logger.warning("put_walls: walls do not match map %s", map_hash)
+            return False
+        self.maps[map_hash] = walls
+        self._save(map_hash, walls)
+        return True
+
+    def _load(self, map_hash):
+        """reads the walls of map_hash from disk, None if missing or damaged"""
+        if self.directory is None or not os.path.exists(self._path(map_hash)):
+            return None
+        try:
+            walls = []
+            with open(self._path(map_hash), "rb") as f:
+                saved = json.load(f)
+            for data in saved:
+                msg = WallUpdateMessage()
+                msg.data = data
+                walls.append(msg.get_wall())
+        except (IOError, ValueError, KeyError, TypeError) as e:
+            self.logger.warning("_load: %s: %s", map_hash, e)
+            return None
+        if walls_hash(walls) != map_hash:
+            self.logger.warning("_load: %s does not match its walls", self._path(map_hash))
+            return None
+        return walls
+
+    def _save(self, map_hash, walls):
+        """writes the walls of map_hash to disk, the cache works without it"""
+        if self.directory is None:
+            return
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            # written whole, then renamed, so a reader never sees half a file
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+            f = os.fdopen(fd, "wb")
+            json.dump([ wall.get_message_data() for wall in walls ], f)
+            f.close()
+            os.rename(tmp_path, self._path(map_hash))
+        except (IOError, OSError) as e:
+            self.logger.warning("_save: %s: %s", map_hash, e)
+        return
@@ -1,5 +1,5 @@
 import math
-from common.object import INFINITE_HEALTH
+from common.object import INFINITE_HEALTH, DYING_TIME
 
 # margin for floating point numbers to be equal
 EPSILON = 0.001
@@ -105,8 +105,23 @@ MISSILE_MANA_RECHARGE_RATE = [ (0.5, XP_LEVELS[XP_LEVEL_0]),
 MISSILE_MANA_COST_RATE = 2./(math.log(10*MISSILE_POWER_HIGH[0])*math.log(MISSILE_RANGE_LONG[0]))
 
 
-# length of time object spends dying
-DYING_TIME = 3.0
+# length of time object spends dying: DYING_TIME, shared with the client
 # length of time game waits before terminating
 GAME_OVER_TIME = 2.0*DYING_TIME
 
+# server -> client updates, see engine_server/send_scheduler.py
+# bytes sent to one connection per tick, before compression,
+# less what the socket has not taken yet
+SEND_BUDGET = 16384
+# missiles closer than this to the client's player go first
+SEND_NEAR_DISTANCE = 200.0
+# priority gained by an update for each tick it waits
+SEND_AGE_BOOST = 0.25
+
+# idle connections, see engine_server/connection_monitor.py
+# seconds without writing to a client before a HEARTBEAT is written
+CONNECTION_HEARTBEAT_INTERVAL = 2.0
+# seconds without hearing from a client before it is dropped,
+# with its match and everything queued for it
+CONNECTION_IDLE_TIMEOUT = 15.0
+
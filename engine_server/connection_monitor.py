@@ -0,0 +1,57 @@
+#
+# Keeps quiet connections alive with heartbeats, and reclaims
+# the ones whose client has stopped talking.
+#
+import time, logging
+from engine_server.config import CONNECTION_HEARTBEAT_INTERVAL, CONNECTION_IDLE_TIMEOUT
+
+class ConnectionMonitor:
+    """
+    Server side, one for all connections.  check() is called
+    regularly, such as once per tick: it writes a HEARTBEAT to every
+    connection that has been quiet for the heartbeat interval, and
+    closes the ones that have sent nothing for the idle timeout,
+    or can't be written to.
+    The on_timeout(comm) callback given to add() then ends the
+    client's match and drops whatever was queued for it.
+    Only connections that agreed to HEARTBEATS ever time out.
+    """
+
+    def __init__(self, heartbeat_interval=CONNECTION_HEARTBEAT_INTERVAL, idle_timeout=CONNECTION_IDLE_TIMEOUT):
+        self.logger = logging.getLogger('ConnectionMonitor')
+        self.heartbeat_interval = heartbeat_interval
+        self.idle_timeout = idle_timeout
+        self.connections = {}   # GameComm -> on_timeout(comm), or None
+        return
+
+    def add(self, comm, on_timeout=None):
+        comm.set_heartbeat(self.heartbeat_interval, self.idle_timeout)
+        self.connections[comm] = on_timeout
+        return
+
+    def remove(self, comm):
+        if comm in self.connections:
+            del self.connections[comm]
+        return
+
+    def get_connections(self):
+        return self.connections.keys()
+
+    def check(self, now=None):
+        """Heartbeats and timeouts for every connection.
+           Returns the GameComms closed for being idle."""
+        if now is None:
+            now = time.time()
+        closed = []
+        for comm in self.connections.keys():
+            if not comm.is_timed_out(now):
+                comm.heartbeat(now)
+                if comm:
+                    continue
+            self.logger.warning("check: no data for %.1f s, closing", comm.get_idle_time(now))
+            on_timeout = self.connections.pop(comm)
+            comm.close()
+            if on_timeout is not None:
+                on_timeout(comm)
+            closed.append(comm)
+        return closed
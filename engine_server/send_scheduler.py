@@ -0,0 +1,158 @@
+#
+# Chooses the object updates a connection gets each tick, within
+# a byte budget, most important first.
+#
+import logging
+from engine_server.config import SEND_BUDGET, SEND_NEAR_DISTANCE, SEND_AGE_BOOST
+
+# order updates are sent in, lowest first
+PRIORITY_PLAYER       = 0  # the client's own player
+PRIORITY_OPPONENT     = 1  # any other player
+PRIORITY_NEAR_MISSILE = 2  # missiles within SEND_NEAR_DISTANCE of the client's player
+PRIORITY_NPC          = 3
+PRIORITY_MISSILE      = 4  # the other missiles
+PRIORITY_WALL         = 5  # static, the client caches the map whatever their order
+
+class PendingUpdate:
+    """The update of one object waiting to be sent."""
+    def __init__(self, obj, msg, tracker):
+        self.obj = obj          # the object, for its priority
+        self.msg = msg          # everything the client has not been sent about it
+        self.tracker = tracker  # the ObjectDeltaTracker that made msg, or None
+        self.age = 0            # ticks it has waited
+        return
+
+class SendScheduler:
+    """
+    Server side, one per client connection.  Other messages
+    (TICK, events, lobby messages) are all sent every tick, in order.
+    Object updates wait by object: a newer update of an object
+    replaces the one still waiting, so a slow client never has more
+    than one queued per object.  Each tick the updates go out by
+    priority until the budget is spent, and the rest move a little
+    closer to the front.
+    Updates come from ObjectDeltaTracker.make_message(), and the
+    tracker is only told the client has one when it is written: an
+    update that waits is made again from what the client really has.
+    """
+
+    def __init__(self, comm, budget=SEND_BUDGET):
+        self.logger = logging.getLogger('SendScheduler')
+        self.comm = comm          # the connection's GameComm
+        self.budget = budget      # bytes per tick
+        self.player = None        # the client's player object, None for a viewer
+        self.messages = []        # other messages, for the next send()
+        self.pending = {}         # (channel, oid) -> PendingUpdate
+        self.superseded = 0       # updates replaced before they were sent
+        return
+
+    def set_budget(self, budget):
+        self.budget = budget
+        return
+
+    def get_budget(self):
+        return self.budget
+
+    def set_player(self, player):
+        self.player = player
+        return
+
+    def get_player(self):
+        return self.player
+
+    def get_backlog(self):
+        """number of objects with an update waiting"""
+        return len(self.pending)
+
+    def get_superseded(self):
+        return self.superseded
+
+    def add_message(self, msg):
+        """Queues a message that is not an object update, sent at the next send()."""
+        self.messages.append(msg)
+        return
+
+    def add_update(self, obj, msg, tracker=None):
+        """Queues the update msg of obj, None for no update.
+           tracker made msg, and commits it once it is written."""
+        if msg is None:
+            return
+        key = (msg.get_channel(), obj.get_oid())
+        waiting = self.pending.get(key)
+        if waiting is None:
+            self.pending[key] = PendingUpdate(obj, msg, tracker)
+            return
+        self.superseded += 1
+        waiting.obj = obj
+        waiting.msg = msg
+        waiting.tracker = tracker
+        return
+
+    def priority(self, obj):
+        if obj.is_player():
+            if self.player is not None and obj.get_oid() == self.player.get_oid():
+                return PRIORITY_PLAYER
+            return PRIORITY_OPPONENT
+        if obj.is_missile():
+            if self.is_near(obj):
+                return PRIORITY_NEAR_MISSILE
+            return PRIORITY_MISSILE
+        if obj.is_npc():
+            return PRIORITY_NPC
+        return PRIORITY_WALL
+
+    def is_near(self, obj):
+        """true if the centers of obj and the client's player are within SEND_NEAR_DISTANCE"""
+        if self.player is None:
+            return False
+        dx = (obj.x + obj.w / 2.) - (self.player.x + self.player.w / 2.)
+        dy = (obj.y + obj.h / 2.) - (self.player.y + self.player.h / 2.)
+        return dx * dx + dy * dy <= SEND_NEAR_DISTANCE * SEND_NEAR_DISTANCE
+
+    def _rank(self, item):
+        key, waiting = item
+        return (self.priority(waiting.obj) - waiting.age * SEND_AGE_BOOST, key)
+
+    def send(self):
+        """
+        Writes this tick's batch: the other messages, then updates by
+        priority while they fit in the budget, less what the socket still
+        holds from earlier ticks.  At least one update goes out per tick.
+        Returns the number of updates sent.
+        """
+        budget = self.budget - self.comm.get_pending_output_size()
+        msgs = self.messages
+        self.messages = []
+        for msg in msgs:
+            budget -= self.comm.frame_size(msg)
+        updates = []
+        for key, waiting in sorted(self.pending.items(), key=self._rank):
+            size = self.comm.frame_size(waiting.msg)
+            if size > budget and updates:
+                break
+            budget -= size
+            msgs.append(waiting.msg)
+            updates.append(waiting)
+            del self.pending[key]
+        for waiting in self.pending.values():
+            waiting.age += 1
+        if self.pending:
+            self.logger.debug('send: %d updates wait for the next tick', len(self.pending))
+        if msgs and self.comm.write_mesgs(msgs):
+            for waiting in updates:
+                if waiting.tracker is not None:
+                    waiting.tracker.commit(waiting.msg)
+        return len(updates)
+
+    def close_channel(self, channel):
+        """Drops everything waiting for channel, on CLOSE_CHANNEL."""
+        self.messages = [ msg for msg in self.messages if msg.get_channel() != channel ]
+        for key in [ key for key in self.pending if key[0] == channel ]:
+            del self.pending[key]
+        return
+
+    def clear(self):
+        """Drops everything waiting, for a new game."""
+        self.messages = []
+        self.pending = {}
+        return